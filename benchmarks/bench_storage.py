@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the ckanext-cloudstorage hot paths, run offline against
+an in-process S3 stand-in. Results are written as JSON.
+
+Needs CKAN and the plugin's requirements installed, but no database, CKAN
+instance or network access. Usage:
+
+    python benchmarks/bench_storage.py [--objects=10000,100000]
+        [--sizes=65536,1048576,16777216] [--output=results.json]
+"""
+import argparse
+import cgi
+import json
+import os
+import platform
+import sys
+import time
+from collections import namedtuple
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_s3 import FakeS3  # noqa: E402
+
+from ckanext.cloudstorage import storage  # noqa: E402
+from ckanext.cloudstorage.logic.action import multipart  # noqa: E402
+
+CONTAINER = 'bench'
+FakeUpload = namedtuple('FakeUpload', 'id name')
+
+
+class FakeFileStorage(cgi.FieldStorage):
+    def __init__(self, fp, filename):
+        self.file = fp
+        self.filename = filename
+
+
+def configure(port, **options):
+    config = {
+        'ckanext.cloudstorage.driver': 'S3',
+        'ckanext.cloudstorage.driver_options': repr({
+            'key': 'bench',
+            'secret': 'bench',
+            'secure': False,
+            'host': '127.0.0.1',
+            'port': port
+        }),
+        'ckanext.cloudstorage.container_name': CONTAINER,
+    }
+    config.update(
+        ('ckanext.cloudstorage.' + key, str(value))
+        for key, value in options.items()
+    )
+    storage.configure(config)
+
+
+def measure(name, func, iterations, setup=None, **extra):
+    """
+    Run `func` `iterations` times, returning a result dict with timings in
+    seconds. `setup`, if given, runs untimed before each call and its
+    result is passed to `func`.
+    """
+    timings = []
+    for _ in range(iterations):
+        arg = setup() if setup else None
+        start = time.time()
+        func(arg) if setup else func()
+        timings.append(time.time() - start)
+
+    timings.sort()
+    result = {
+        'name': name,
+        'iterations': iterations,
+        'min_s': timings[0],
+        'median_s': timings[len(timings) // 2],
+        'mean_s': sum(timings) / len(timings),
+        'ops_per_s': len(timings) / (sum(timings) or 1e-9)
+    }
+    result.update(extra)
+    sys.stderr.write('{name}: {median_s:.6f}s median\n'.format(**result))
+    return result
+
+
+def bench_construction(server):
+    configure(server.port)
+    return [measure(
+        'cloudstorage_construction',
+        lambda: storage.ResourceCloudStorage({}),
+        1000
+    )]
+
+
+def bench_urls(server):
+    results = []
+    server.bucket.put('resources/rid/data.csv', b'a,b,c\n')
+
+    for check in (True, False):
+        configure(server.port, check_object_exists=check)
+        uploader = storage.ResourceCloudStorage({})
+        results.append(measure(
+            'get_url_public_{0}'.format('checked' if check else 'local'),
+            lambda: uploader.get_url_from_filename('rid', 'data.csv'),
+            1000
+        ))
+
+    for cache_size in (0, 1000):
+        configure(
+            server.port,
+            use_secure_urls=True,
+            secure_url_cache_size=cache_size
+        )
+        uploader = storage.ResourceCloudStorage({})
+        results.append(measure(
+            'get_url_secure_{0}'.format(
+                'cached' if cache_size else 'uncached'),
+            lambda: uploader.get_url_from_filename('rid', 'data.csv'),
+            1000
+        ))
+    return results
+
+
+def bench_upload(server, sizes):
+    results = []
+    configure(server.port)
+    for size in sizes:
+        data = os.urandom(size)
+
+        def setup():
+            return storage.ResourceCloudStorage({
+                'upload': FakeFileStorage(BytesIO(data), 'data.bin')
+            })
+
+        results.append(measure(
+            'upload_{0}'.format(size),
+            lambda uploader: uploader.upload('rid'),
+            max(3, min(100, (64 * 1024 * 1024) // size)),
+            setup=setup,
+            bytes=size
+        ))
+    return results
+
+
+def bench_resource_cleanup(server, counts):
+    """
+    Time finding and deleting one resource's 10 objects in a container of
+    `count` objects, the work `before_delete` does after the DB lookup.
+    """
+    results = []
+    configure(server.port)
+    for count in counts:
+        server.bucket.objects.clear()
+        for i in range(count - 10):
+            server.bucket.put('resources/{0:08d}/data.csv'.format(i), b'x')
+
+        def setup():
+            for i in range(10):
+                server.bucket.put('resources/target/{0}.csv'.format(i), b'x')
+            return storage.ResourceCloudStorage({})
+
+        results.append(measure(
+            'resource_cleanup_{0}'.format(count),
+            lambda uploader: uploader.delete_objects(
+                uploader.iterate_resource_objects('target')),
+            5,
+            setup=setup,
+            objects=count
+        ))
+    server.bucket.objects.clear()
+    return results
+
+
+def bench_multipart(server):
+    results = []
+    configure(server.port)
+    uploader = storage.ResourceCloudStorage({})
+    name = 'resources/rid/large.bin'
+    part = BytesIO(os.urandom(storage.MIN_PART_SIZE))
+
+    results.append(measure(
+        'multipart_initiate',
+        lambda: multipart._initiate_upload(uploader, name),
+        100
+    ))
+
+    upload_id = multipart._initiate_upload(uploader, name)
+    results.append(measure(
+        'multipart_upload_part',
+        lambda: multipart._stream_part(
+            uploader,
+            multipart._get_part_url(uploader, name, upload_id, 1),
+            part
+        ).status,
+        20,
+        bytes=storage.MIN_PART_SIZE
+    ))
+
+    upload = FakeUpload(upload_id, name)
+    now = time.time()
+    results.append(measure(
+        'multipart_sign_part',
+        lambda: multipart._sign_part_url(uploader, upload, 1, 3600, now),
+        1000
+    ))
+
+    def setup_commit():
+        upload_id = multipart._initiate_upload(uploader, name)
+        resp = multipart._stream_part(
+            uploader,
+            multipart._get_part_url(uploader, name, upload_id, 1),
+            part
+        )
+        return upload_id, [(1, resp.headers['etag'])]
+
+    results.append(measure(
+        'multipart_finish',
+        lambda args: uploader.driver._commit_multipart(
+            multipart._get_object_url(uploader, name), *args),
+        20,
+        setup=setup_commit
+    ))
+
+    def setup_abort():
+        return [
+            (name, multipart._initiate_upload(uploader, name))
+            for _ in range(100)
+        ]
+
+    results.append(measure(
+        'multipart_abort_100',
+        lambda uploads: list(multipart._abort_uploads(uploads, 8)),
+        5,
+        setup=setup_abort
+    ))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--objects', default='10000')
+    parser.add_argument('--sizes', default='65536,1048576,16777216')
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    server = FakeS3().start()
+    try:
+        results = []
+        results.extend(bench_construction(server))
+        results.extend(bench_urls(server))
+        results.extend(bench_upload(
+            server, [int(s) for s in args.sizes.split(',')]))
+        results.extend(bench_resource_cleanup(
+            server, [int(c) for c in args.objects.split(',')]))
+        results.extend(bench_multipart(server))
+    finally:
+        server.stop()
+
+    report = json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            fout.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A minimal in-process stand-in for the S3 API, good enough for libcloud's S3
+driver and the requests ckanext-cloudstorage makes itself. Objects are kept
+in memory and signatures are not checked.
+"""
+import hashlib
+import re
+import threading
+import uuid
+from xml.etree.ElementTree import fromstring
+from xml.sax.saxutils import escape
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+PAGE_SIZE = 1000
+
+
+class Bucket(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (data, etag, content type)
+        self.objects = {}
+        # upload id -> (key, {part number: (data, etag)})
+        self.uploads = {}
+
+    def put(self, key, data, content_type='application/octet-stream'):
+        etag = hashlib.md5(data).hexdigest()
+        with self.lock:
+            self.objects[key] = (data, etag, content_type)
+        return etag
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _parse(self):
+        url = urlparse(self.path)
+        parts = unquote(url.path).lstrip('/').split('/', 1)
+        key = parts[1] if len(parts) > 1 else ''
+        return key, parse_qs(url.query, keep_blank_values=True)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status, body=b'', headers=None):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, root, body):
+        return self._reply(200, (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<{0} xmlns="{1}">{2}</{0}>'.format(root, NAMESPACE, body)
+        ), {'Content-Type': 'application/xml'})
+
+    @property
+    def bucket(self):
+        return self.server.bucket
+
+    def do_HEAD(self):
+        key, _ = self._parse()
+        if not key:
+            return self._reply(200)
+        obj = self.bucket.objects.get(key)
+        if obj is None:
+            return self._reply(404)
+        self.send_response(200)
+        self.send_header('ETag', '"{0}"'.format(obj[1]))
+        self.send_header('Content-Type', obj[2])
+        self.send_header('Content-Length', str(len(obj[0])))
+        self.end_headers()
+
+    def do_GET(self):
+        key, query = self._parse()
+        if key:
+            obj = self.bucket.objects.get(key)
+            if obj is None:
+                return self._reply(404)
+            return self._reply(200, obj[0], {
+                'ETag': '"{0}"'.format(obj[1]),
+                'Content-Type': obj[2]
+            })
+        if 'uploads' in query:
+            return self._list_uploads(query)
+        return self._list_objects(query)
+
+    def _list_objects(self, query):
+        prefix = query.get('prefix', [''])[0]
+        marker = query.get('marker', [''])[0]
+        with self.bucket.lock:
+            keys = sorted(
+                k for k in self.bucket.objects
+                if k.startswith(prefix) and k > marker
+            )
+            page = [(k, self.bucket.objects[k]) for k in keys[:PAGE_SIZE]]
+        contents = ''.join(
+            '<Contents><Key>{0}</Key><LastModified>2017-01-01T00:00:00.000Z'
+            '</LastModified><ETag>"{1}"</ETag><Size>{2}</Size></Contents>'
+            .format(escape(k), obj[1], len(obj[0]))
+            for k, obj in page
+        )
+        return self._xml('ListBucketResult', (
+            '<IsTruncated>{0}</IsTruncated>{1}'.format(
+                'true' if len(keys) > PAGE_SIZE else 'false', contents)
+        ))
+
+    def _list_uploads(self, query):
+        prefix = query.get('prefix', [''])[0]
+        with self.bucket.lock:
+            uploads = [
+                (upload_id, key)
+                for upload_id, (key, _) in self.bucket.uploads.items()
+                if key.startswith(prefix)
+            ]
+        return self._xml('ListMultipartUploadsResult', (
+            '<IsTruncated>false</IsTruncated>' + ''.join(
+                '<Upload><Key>{0}</Key><UploadId>{1}</UploadId>'
+                '<Initiator><DisplayName>bench</DisplayName></Initiator>'
+                '<Owner><DisplayName>bench</DisplayName></Owner>'
+                '<Initiated>2000-01-01T00:00:00.000Z</Initiated></Upload>'
+                .format(escape(key), upload_id)
+                for upload_id, key in uploads
+            )
+        ))
+
+    def do_PUT(self):
+        key, query = self._parse()
+        data = self._body()
+        if 'uploadId' in query:
+            upload_id = query['uploadId'][0]
+            etag = hashlib.md5(data).hexdigest()
+            with self.bucket.lock:
+                if upload_id not in self.bucket.uploads:
+                    return self._reply(404)
+                parts = self.bucket.uploads[upload_id][1]
+                parts[int(query['partNumber'][0])] = (data, etag)
+        else:
+            etag = self.bucket.put(
+                key, data,
+                self.headers.get('Content-Type', 'application/octet-stream')
+            )
+        return self._reply(200, headers={'ETag': '"{0}"'.format(etag)})
+
+    def do_POST(self):
+        key, query = self._parse()
+        body = self._body()
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.bucket.lock:
+                self.bucket.uploads[upload_id] = (key, {})
+            return self._xml('InitiateMultipartUploadResult', (
+                '<Key>{0}</Key><UploadId>{1}</UploadId>'.format(
+                    escape(key), upload_id)
+            ))
+        if 'uploadId' in query:
+            return self._complete(key, query['uploadId'][0], body)
+        if 'delete' in query:
+            keys = re.findall(r'<Key>(.*?)</Key>', body.decode('utf-8'))
+            with self.bucket.lock:
+                for k in keys:
+                    self.bucket.objects.pop(k, None)
+            return self._xml('DeleteResult', '')
+        return self._reply(400)
+
+    def _complete(self, key, upload_id, body):
+        numbers = [
+            int(e.text) for e in fromstring(body).iter()
+            if e.tag.endswith('PartNumber')
+        ]
+        with self.bucket.lock:
+            upload = self.bucket.uploads.pop(upload_id, None)
+        if upload is None:
+            return self._reply(404)
+        parts = upload[1]
+        data = b''.join(parts[n][0] for n in numbers)
+        etag = '{0}-{1}'.format(
+            hashlib.md5(
+                b''.join(bytearray.fromhex(parts[n][1]) for n in numbers)
+            ).hexdigest(),
+            len(numbers)
+        )
+        with self.bucket.lock:
+            self.bucket.objects[key] = (data, etag, 'application/octet-stream')
+        return self._xml('CompleteMultipartUploadResult', (
+            '<Key>{0}</Key><ETag>"{1}"</ETag>'.format(escape(key), etag)
+        ))
+
+    def do_DELETE(self):
+        key, query = self._parse()
+        with self.bucket.lock:
+            if 'uploadId' in query:
+                found = self.bucket.uploads.pop(query['uploadId'][0], None)
+            else:
+                found = self.bucket.objects.pop(key, None)
+        return self._reply(204 if found is not None else 404)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeS3(object):
+    def __init__(self):
+        """
+        Serve a single in-memory bucket on a random localhost port.
+        """
+        self.bucket = Bucket()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.bucket = self.bucket
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import Queue
+import errno
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from ckan import model
+import ckan.plugins as p
+from sqlalchemy import text
+
+from ckanext.cloudstorage.storage import ResourceCloudStorage
+from ckanext.cloudstorage.model import PendingUpload
+
+log = logging.getLogger(__name__)
+
+# How much of an upload is held in memory at once while spooling it.
+SPOOL_BUFFER_SIZE = 1024 * 1024
+
+# The `local` queue and its worker threads, started on first use in each
+# process.
+_local = {'queue': None, 'pid': None}
+_local_lock = threading.Lock()
+
+
+def _spool(uploader):
+    """
+    Copy the uploaded file to a new file in `background_upload_dir`,
+    returning its path.
+    """
+    directory = uploader.background_upload_dir
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    spool_path = os.path.join(directory, uuid.uuid4().hex)
+    try:
+        uploader.file_upload.seek(0)
+    except (AttributeError, IOError):
+        pass
+    with open(spool_path, 'wb') as fout:
+        shutil.copyfileobj(uploader.file_upload, fout, SPOOL_BUFFER_SIZE)
+    return spool_path
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            log.exception('Unable to remove spooled upload %s', path)
+
+
+def enqueue(uploader, resource_id):
+    """
+    Spool the file being uploaded for `resource_id` to disk, mark the
+    resource as pending and queue its transfer to the provider.
+
+    :param uploader: The ResourceCloudStorage holding the upload.
+    :param resource_id: The resource_id.
+    """
+    spool_path = _spool(uploader)
+
+    pending = model.Session.query(PendingUpload).get(resource_id)
+    if pending is not None:
+        # A newer file replaces one that hasn't been sent yet.
+        _remove(pending.spool_path)
+        model.Session.delete(pending)
+        model.Session.flush()
+    model.Session.add(
+        PendingUpload(resource_id, uploader.filename, spool_path)
+    )
+    model.Session.commit()
+
+    queue = uploader.background_upload_queue
+    if queue == 'jobs' and hasattr(p.toolkit, 'enqueue_job'):
+        p.toolkit.enqueue_job(
+            upload_pending,
+            [resource_id, spool_path],
+            title=u'cloudstorage upload of {0}'.format(resource_id)
+        )
+    else:
+        if queue == 'jobs':
+            log.warning(
+                'Background jobs are not available in this version of CKAN,'
+                ' using the local upload queue.'
+            )
+        _local_queue(uploader.background_upload_workers).put(
+            (resource_id, spool_path)
+        )
+
+
+def _local_queue(workers):
+    with _local_lock:
+        if _local['pid'] != os.getpid():
+            _local['queue'] = Queue.Queue()
+            _local['pid'] = os.getpid()
+            for _ in range(workers):
+                thread = threading.Thread(target=_local_worker)
+                thread.daemon = True
+                thread.start()
+        return _local['queue']
+
+
+def _local_worker():
+    queue = _local['queue']
+    while True:
+        resource_id, spool_path = queue.get()
+        try:
+            upload_pending(resource_id, spool_path)
+        except Exception:
+            log.exception('Background upload of %s failed', resource_id)
+        finally:
+            queue.task_done()
+
+
+def _pending(resource_id, spool_path):
+    """
+    Query the PendingUpload row for `resource_id` only while it is still
+    the one queued for `spool_path`, so a superseded job never touches the
+    row of a newer upload.
+    """
+    return model.Session.query(PendingUpload).filter_by(
+        resource_id=resource_id,
+        spool_path=spool_path
+    )
+
+
+def _is_current(resource_id, spool_path):
+    return model.Session.query(
+        _pending(resource_id, spool_path).exists()
+    ).scalar()
+
+
+@contextmanager
+def _resource_lock(resource_id):
+    """
+    Hold a Postgres advisory lock for `resource_id`, so two uploads of the
+    same resource are sent one after the other, oldest first, even from
+    different processes.
+    """
+    connection = model.meta.engine.connect()
+    try:
+        connection.execute(
+            text('SELECT pg_advisory_lock(hashtext(:key))'),
+            key=u'cloudstorage:' + resource_id
+        )
+        try:
+            yield
+        finally:
+            connection.execute(
+                text('SELECT pg_advisory_unlock(hashtext(:key))'),
+                key=u'cloudstorage:' + resource_id
+            )
+    finally:
+        connection.close()
+
+
+def upload_pending(resource_id, spool_path):
+    """
+    Send a spooled file to the provider, retrying up to `upload_retries`
+    times. Runs in a background job or a `local` queue worker.
+
+    :param resource_id: The resource_id.
+    :param spool_path: The spooled file queued for the resource.
+    """
+    try:
+        with _resource_lock(resource_id):
+            _upload_pending(resource_id, spool_path)
+    finally:
+        model.Session.remove()
+
+
+def _upload_pending(resource_id, spool_path):
+    pending = _pending(resource_id, spool_path).first()
+    if pending is None:
+        # Superseded by a newer upload of the same resource.
+        _remove(spool_path)
+        return
+    filename = pending.filename
+
+    resource = model.Session.query(model.Resource).get(resource_id)
+    if resource is None or resource.state != 'active':
+        _pending(resource_id, spool_path).delete(synchronize_session=False)
+        model.Session.commit()
+        _remove(spool_path)
+        return
+
+    uploader = ResourceCloudStorage({'package_id': resource.package_id})
+    uploader.filename = filename
+    attempt = 0
+    while True:
+        attempt += 1
+        # Each check ends the transaction, so it sees rows replaced by
+        # uploads queued in the meantime.
+        model.Session.commit()
+        if not _is_current(resource_id, spool_path):
+            _remove(spool_path)
+            return
+        try:
+            with open(spool_path, 'rb') as fin:
+                uploader.file_upload = fin
+                uploader.upload_file(resource_id)
+            break
+        except Exception as e:
+            failed = attempt > uploader.upload_retries
+            values = {'attempts': attempt, 'error': u'{0}'.format(e)}
+            if failed:
+                values['status'] = u'failed'
+            model.Session.rollback()
+            if not _pending(resource_id, spool_path).update(
+                    values, synchronize_session=False):
+                model.Session.commit()
+                _remove(spool_path)
+                return
+            model.Session.commit()
+            if failed:
+                log.error(
+                    'Background upload of %s failed after %s attempts:'
+                    ' %s', resource_id, attempt, e
+                )
+                return
+            log.warning(
+                'Retrying background upload of %s after error: %s',
+                resource_id, e
+            )
+            time.sleep(2 ** attempt)
+
+    _pending(resource_id, spool_path).delete(synchronize_session=False)
+    model.Session.commit()
+    _remove(spool_path)
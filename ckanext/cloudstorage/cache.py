@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    def __init__(self, maxsize, ttl):
+        """
+        A small thread-safe LRU cache whose entries also expire `ttl`
+        seconds after they were stored.
+
+        :param maxsize: The maximum number of entries to keep. When full,
+                        the least recently used entry is evicted.
+        :param ttl: The default lifetime of an entry, in seconds.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under `key`, or `default` if it is missing
+        or has expired.
+        """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= time.time():
+                self.misses += 1
+                return default
+
+            # Re-insert to mark the entry as most recently used.
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store `value` under `key`, evicting the least recently used entry
+        if the cache is full.
+
+        :param ttl: Optionally override the cache's default lifetime.
+        """
+        if self.maxsize <= 0:
+            return
+
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+            self._data[key] = (expires, value)
+
+    def pop(self, key, default=None):
+        """
+        Remove `key` from the cache, returning its value if present.
+        """
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Return a dict with the cache's size and hit/miss counters.
+        """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
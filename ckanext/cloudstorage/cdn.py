@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import urllib
+import urlparse
+
+
+def load_private_key(path):
+    """
+    Load the PEM encoded RSA private key at `path` used to sign CloudFront
+    URLs.
+
+    :raises RuntimeError: If the `cryptography` package isn't installed.
+    """
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+    except ImportError:
+        raise RuntimeError(
+            'Signing CloudFront URLs needs the cryptography package.'
+        )
+
+    with open(path, 'rb') as fin:
+        return serialization.load_pem_private_key(
+            fin.read(),
+            password=None,
+            backend=default_backend()
+        )
+
+
+def cdn_url(base_url, path, path_map=None):
+    """
+    Return the URL of the object at `path` on the CDN at `base_url`.
+
+    :param path_map: Optionally a dict of key prefixes to the CDN path
+                     prefixes they are served under. The longest matching
+                     prefix is replaced.
+    """
+    for prefix in sorted(path_map or (), key=len, reverse=True):
+        if path.startswith(prefix):
+            path = path_map[prefix] + path[len(prefix):]
+            break
+    return '{0}/{1}'.format(
+        base_url.rstrip('/'),
+        urllib.quote(path.lstrip('/'))
+    )
+
+
+def _append_query(url, query):
+    return '{0}{1}{2}'.format(url, '&' if '?' in url else '?', query)
+
+
+def sign_hmac(url, key, expires, token_name='__token__'):
+    """
+    Sign `url` with an HMAC-SHA256 token valid until the unix timestamp
+    `expires`, in the `exp=<expires>~acl=<path>~hmac=<digest>` format
+    understood by Akamai and easily checked at other edges.
+
+    :param key: The shared secret, hex encoded.
+    """
+    fields = 'exp={0}~acl={1}'.format(
+        int(expires),
+        urlparse.urlsplit(url).path
+    )
+    digest = hmac.new(
+        binascii.unhexlify(key),
+        fields.encode('utf-8'),
+        hashlib.sha256
+    ).hexdigest()
+    return _append_query(url, '{0}={1}~hmac={2}'.format(
+        token_name, fields, digest
+    ))
+
+
+def sign_cloudfront(url, key_pair_id, private_key, expires):
+    """
+    Sign `url` with a CloudFront canned policy valid until the unix
+    timestamp `expires`.
+
+    :param private_key: The key pair's RSA key, from `load_private_key`.
+    """
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    # CloudFront signs the canned policy exactly as it rebuilds it, so the
+    # keys must come in this order without any whitespace.
+    policy = (
+        '{{"Statement":[{{"Resource":{0},'
+        '"Condition":{{"DateLessThan":{{"AWS:EpochTime":{1}}}}}}}]}}'
+    ).format(json.dumps(url), int(expires))
+    signature = private_key.sign(
+        policy.encode('utf-8'),
+        padding.PKCS1v15(),
+        hashes.SHA1()
+    )
+    # CloudFront's URL-safe base64 alphabet.
+    signature = base64.b64encode(signature).decode('ascii').translate(
+        {ord(u'+'): u'-', ord(u'='): u'_', ord(u'/'): u'~'}
+    )
+    return _append_query(
+        url,
+        'Expires={0}&Signature={1}&Key-Pair-Id={2}'.format(
+            int(expires), signature, key_pair_id
+        )
+    )
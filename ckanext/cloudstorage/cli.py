@@ -3,36 +3,73 @@
 import os
 import os.path
 import cgi
+import datetime
+import hashlib
 import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from docopt import docopt
 from ckan.lib.cli import CkanCommand
 
 from ckanapi import LocalCKAN
+from ckanext.cloudstorage import stats
 from ckanext.cloudstorage.storage import (
     CloudStorage,
     ResourceCloudStorage
 )
 from ckanext.cloudstorage.model import (
+    CloudStorageObject,
     create_tables,
-    drop_tables
+    drop_tables,
+    unquote_etag,
+    upgrade_tables
 )
+from ckan import model
 from ckan.logic import NotFound
 
+# Part sizes tried when checking a file against a multipart ETag, after
+# the configured `multipart_part_size` and libcloud's own.
+MULTIPART_PART_SIZES = [5 * 1024 * 1024 * 2 ** i for i in range(12)]
+# The part size libcloud's S3 driver uploads streams in.
+LIBCLOUD_PART_SIZE = 5 * 1024 * 1024
+# How many listed objects `reconcile` records per transaction.
+RECONCILE_BATCH_SIZE = 1000
+
 USAGE = """ckanext-cloudstorage
 
 Commands:
     - fix-cors       Update CORS rules where possible.
     - migrate        Upload local storage to the remote.
     - initdb         Reinitalize database tables.
+    - upgradedb      Add new tables and indexes, keeping existing data.
+    - reconcile      Bring the object manifest in line with the provider.
+    - clean-multipart
+                     Abort expired multipart uploads.
 
 Usage:
     cloudstorage fix-cors <domains>... [--c=<config>]
-    cloudstorage migrate <path_to_storage> [<resource_id>] [--c=<config>]
+    cloudstorage migrate <path_to_storage> [<resource_id>] [--workers=<n>]
+                         [--checkpoint=<file>] [--incremental] [--dry-run]
+                         [--c=<config>]
     cloudstorage initdb [--c=<config>]
+    cloudstorage upgradedb [--c=<config>]
+    cloudstorage reconcile [--c=<config>]
+    cloudstorage clean-multipart [--orphans] [--workers=<n>] [--c=<config>]
 
 Options:
-    -c=<config>       The CKAN configuration file.
+    -c=<config>           The CKAN configuration file.
+    --workers=<n>         Number of files to upload or uploads to abort at
+                          once. Defaults to 1 for migrate and to
+                          `ckanext.cloudstorage.delete_workers` otherwise.
+    --checkpoint=<file>   File recording finished resource ids, so an
+                          interrupted migration can be resumed.
+    --incremental         Only upload files that are missing from the
+                          container or whose content has changed.
+    --dry-run             Report what would be uploaded without uploading.
+    --orphans             Also abort expired uploads that exist at the
+                          provider but are unknown to CKAN.
 """
 
 
@@ -56,6 +93,12 @@ class PasterCommand(CkanCommand):
             _migrate(args)
         elif args['initdb']:
             _initdb()
+        elif args['upgradedb']:
+            _upgradedb()
+        elif args['reconcile']:
+            _reconcile()
+        elif args['clean-multipart']:
+            _clean_multipart(args)
 
 
 def _migrate(args):
@@ -98,39 +141,214 @@ def _migrate(args):
                 file_
             )
 
-    for i, resource in enumerate(resources.iteritems(), 1):
-        resource_id, file_path = resource
-        print('[{i}/{count}] Working on {id}'.format(
-            i=i,
-            count=len(resources),
-            id=resource_id
-        ))
+    done = set()
+    checkpoint = args['--checkpoint']
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as fin:
+            done = set(line.strip() for line in fin if line.strip())
+        print(u'Skipping {0} resources already migrated'.format(len(done)))
+
+    index = None
+    if args['--incremental'] or args['--dry-run']:
+        index = _build_index()
+        print(u'{0} objects already in the container'.format(len(index)))
+
+    pending = sorted(
+        (resource_id, file_path)
+        for resource_id, file_path in resources.iteritems()
+        if resource_id not in done
+    )
+
+    lock = threading.Lock()
+    dry_run = args['--dry-run']
+    progress = {'count': 0, 'files': 0, 'bytes': 0}
+    started = time.time()
+    checkpoint_file = open(checkpoint, 'a') if checkpoint else None
 
+    def migrate_one(item):
+        resource_id, file_path = item
+        error = None
+        transferred = 0
         try:
-            resource = lc.action.resource_show(id=resource_id)
-        except NotFound:
-            print(u'\tResource not found')
-            continue
-        if resource['url_type'] != 'upload':
-            print(u'\t`url_type` is not `upload`. Skip')
-            continue
+            message, transferred = _migrate_resource(
+                lc, resource_id, file_path, index=index, dry_run=dry_run)
+        except Exception as e:
+            error = e
+            message = u'Error of type {0} during upload: {1}'.format(
+                type(e), e)
 
-        with open(file_path, 'rb') as fin:
-            resource['upload'] = FakeFileStorage(
-                fin,
-                resource['url'].split('/')[-1]
-            )
-            try:
-                uploader = ResourceCloudStorage(resource)
-                uploader.upload(resource['id'])
-            except Exception as e:
+        with lock:
+            progress['count'] += 1
+            if error is not None:
                 failed.append(resource_id)
-                print(u'\tError of type {0} during upload: {1}'.format(type(e), e))
+            else:
+                if transferred is not None:
+                    progress['files'] += 1
+                    progress['bytes'] += transferred
+                if checkpoint_file and not dry_run:
+                    checkpoint_file.write(resource_id + '\n')
+                    checkpoint_file.flush()
+
+            elapsed = max(time.time() - started, 0.001)
+            print(
+                u'[{i}/{count}] {id}: {message}'
+                u' ({files:.1f} files/s, {mbytes:.2f} MB/s)'.format(
+                    i=progress['count'],
+                    count=len(pending),
+                    id=resource_id,
+                    message=message,
+                    files=progress['files'] / elapsed,
+                    mbytes=progress['bytes'] / elapsed / (1024 * 1024)
+                )
+            )
+
+    # Every worker thread uses its own pooled driver connection.
+    pool = ThreadPool(int(args['--workers'] or 1))
+    try:
+        for _ in pool.imap_unordered(migrate_one, pending):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+        if checkpoint_file:
+            checkpoint_file.close()
+
+    if dry_run:
+        print(u'{0} files ({1} bytes) would be uploaded'.format(
+            progress['files'], progress['bytes']))
+    _print_stats()
 
     if failed:
         log_file = tempfile.NamedTemporaryFile(delete=False)
-        log_file.file.writelines(failed)
-        print(u'ID of all failed uploads are saved to `{0}`'.format(log_file.name))
+        log_file.file.write(''.join(id + '\n' for id in failed))
+        log_file.close()
+        print(u'ID of all failed uploads are saved to `{0}`'.format(
+            log_file.name))
+
+
+def _print_stats():
+    """
+    Print how many provider calls of each kind were made and how long they
+    took.
+    """
+    operations = stats.snapshot()['operations']
+    for name, op in sorted(operations.items()):
+        print(
+            u'{name}: {count} calls, {errors} errors, {bytes} bytes,'
+            u' {mean:.1f}ms mean, {max_ms:.1f}ms max'.format(
+                name=name,
+                mean=op['total_ms'] / op['count'],
+                **op
+            )
+        )
+
+
+def _build_index():
+    """
+    List every resource object in the container once, returning a dict of
+    key -> (size, etag).
+    """
+    cs = ResourceCloudStorage({})
+    prefix = cs.resources_prefix
+    return dict(
+        (obj.name, (obj.size, (obj.hash or '').strip('"')))
+        for obj in cs.iterate_prefix(prefix)
+    )
+
+
+def _file_md5(file_path, part_size=None):
+    """
+    Return the MD5 of a file, or the multipart ETag S3 would give it if
+    uploaded in parts of `part_size` bytes, reading it in small buffers.
+    """
+    buffer_size = 1024 * 1024
+    digests = []
+    md5 = hashlib.md5()
+    read = 0
+    with open(file_path, 'rb') as fin:
+        while True:
+            # Never read across a part boundary.
+            buf = fin.read(
+                min(buffer_size, part_size - read) if part_size
+                else buffer_size
+            )
+            if not buf:
+                break
+            md5.update(buf)
+            read += len(buf)
+            if part_size and read >= part_size:
+                digests.append(md5.digest())
+                md5 = hashlib.md5()
+                read = 0
+    if not part_size:
+        return md5.hexdigest()
+
+    if read or not digests:
+        digests.append(md5.digest())
+    return '{0}-{1}'.format(
+        hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def _part_sizes():
+    """
+    Return the part sizes a multipart object could have been uploaded
+    with, most likely first.
+    """
+    sizes = []
+    for part_size in [
+            CloudStorage.multipart_part_size.fget(None),
+            LIBCLOUD_PART_SIZE] + MULTIPART_PART_SIZES:
+        if part_size not in sizes:
+            sizes.append(part_size)
+    return sizes
+
+
+def _is_unchanged(file_path, size, etag):
+    if os.path.getsize(file_path) != size:
+        return False
+    if '-' not in etag:
+        return _file_md5(file_path) == etag
+
+    # Multipart ETags depend on the part size, which isn't recorded, so
+    # try the sizes that would give the same number of parts.
+    parts = int(etag.split('-')[1])
+    return any(
+        _file_md5(file_path, part_size) == etag
+        for part_size in _part_sizes()
+        if -(-size // part_size) == parts
+    )
+
+
+def _migrate_resource(lc, resource_id, file_path, index=None,
+                      dry_run=False):
+    """
+    Upload a single file from local storage, returning a message and the
+    number of bytes uploaded, or None if it was skipped.
+    """
+    try:
+        resource = lc.action.resource_show(id=resource_id)
+    except NotFound:
+        return u'Resource not found', None
+    if resource['url_type'] != 'upload':
+        return u'`url_type` is not `upload`. Skip', None
+
+    filename = resource['url'].split('/')[-1]
+    size = os.path.getsize(file_path)
+    if index is not None:
+        key = ResourceCloudStorage({}).path_from_filename(
+            resource['id'], filename)
+        if key in index and _is_unchanged(file_path, *index[key]):
+            return u'Unchanged. Skip', None
+    if dry_run:
+        return u'Would upload {0} bytes'.format(size), size
+
+    with open(file_path, 'rb') as fin:
+        resource['upload'] = FakeFileStorage(fin, filename)
+        uploader = ResourceCloudStorage(resource)
+        # Always sent right away: a background upload would only be queued,
+        # and the `local` queue's workers die with this command.
+        uploader.upload_file(resource['id'])
+    return u'Uploaded', size
 
 
 def _fix_cors(args):
@@ -145,14 +363,15 @@ def _fix_cors(args):
             cs.driver_options['secret']
         )
 
-        blob_service.set_blob_service_properties(
-            cors=[
-                CorsRule(
-                    allowed_origins=args['<domains>'],
-                    allowed_methods=['GET']
-                )
-            ]
-        )
+        with stats.timed('set_cors'):
+            blob_service.set_blob_service_properties(
+                cors=[
+                    CorsRule(
+                        allowed_origins=args['<domains>'],
+                        allowed_methods=['GET']
+                    )
+                ]
+            )
         print('Done!')
     else:
         print(
@@ -168,3 +387,99 @@ def _initdb():
     drop_tables()
     create_tables()
     print("DB tables are reinitialized")
+
+
+def _upgradedb():
+    upgrade_tables()
+    print("DB tables are upgraded")
+
+
+def _reconcile():
+    cs = ResourceCloudStorage({})
+    prefix = cs.resources_prefix
+    started = datetime.datetime.utcnow()
+    seen = set()
+
+    # The manifest is updated in place, a batch per transaction, so running
+    # CKAN instances never see it half-empty and the content hashes and
+    # encodings recorded at upload time survive.
+    count = 0
+    batch = []
+    for count, obj in enumerate(cs.iterate_prefix(prefix), 1):
+        batch.append(obj)
+        if len(batch) == RECONCILE_BATCH_SIZE:
+            _reconcile_batch(batch, seen)
+            batch = []
+            print(u'{0} objects recorded'.format(count))
+    _reconcile_batch(batch, seen)
+
+    # Objects recorded since the listing began may have been missed by it.
+    stale = [
+        key for key, uploaded in model.Session.query(
+            CloudStorageObject.key,
+            CloudStorageObject.uploaded
+        ).filter(
+            CloudStorageObject.key.startswith(prefix)
+        ).yield_per(RECONCILE_BATCH_SIZE)
+        if key not in seen and (uploaded is None or uploaded < started)
+    ]
+    for i in range(0, len(stale), RECONCILE_BATCH_SIZE):
+        CloudStorageObject.forget(stale[i:i + RECONCILE_BATCH_SIZE])
+    print(u'Manifest reconciled with {0} objects, {1} removed'.format(
+        count, len(stale)))
+
+
+def _reconcile_batch(objects, seen):
+    """
+    Record the listed `objects` in the manifest and commit, keeping what
+    is known about entries whose ETag didn't change.
+    """
+    if not objects:
+        return
+    existing = dict(
+        (row.key, row) for row in model.Session.query(
+            CloudStorageObject
+        ).filter(
+            CloudStorageObject.key.in_([obj.name for obj in objects])
+        )
+    )
+    for obj in objects:
+        seen.add(obj.name)
+        row = existing.get(obj.name)
+        if row is None:
+            model.Session.add(CloudStorageObject(
+                obj.name,
+                obj.name.split('/')[1],
+                size=obj.size,
+                etag=obj.hash,
+                content_type=obj.extra.get('content_type')
+            ))
+            continue
+        etag = unquote_etag(obj.hash)
+        # Entries recorded by older versions may still be quoted.
+        if unquote_etag(row.etag) != etag:
+            # Rewritten behind our back, what we knew no longer holds.
+            row.content_encoding = None
+            row.content_hash = None
+        row.size = obj.size
+        row.etag = etag
+        row.content_type = obj.extra.get('content_type') or row.content_type
+    model.Session.commit()
+
+
+def _clean_multipart(args):
+    from ckanext.cloudstorage.logic.action import multipart
+
+    oldest_allowed = (
+        datetime.datetime.utcnow() - multipart._get_max_multipart_lifetime()
+    )
+    result = multipart._clean_expired(
+        ResourceCloudStorage({}),
+        oldest_allowed,
+        orphans=args['--orphans'],
+        workers=int(args['--workers'] or 0)
+    )
+    for error in result['errors']:
+        print(u'\tError: {0}'.format(error))
+    print(u'Aborted {removed}/{total} expired uploads'
+          u' and {orphans} orphaned uploads'.format(**result))
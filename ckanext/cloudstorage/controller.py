@@ -1,14 +1,63 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import hashlib
+import mimetypes
 import os.path
+import re
+import time
+from email.utils import formatdate
 
-from pylons import c
+from pylons import c, request, response
 from pylons.i18n import _
 
 from ckan import logic, model
 from ckan.lib import base, uploader
 import ckan.lib.helpers as h
 
+from ckanext.cloudstorage.model import PendingUpload
+from ckanext.cloudstorage.storage import (
+    CloudStorage,
+    download_auth_cache,
+    download_auth_key,
+    missing_object_cache
+)
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _parse_range(header, size):
+    """
+    Parse a single-range `Range` header against an object of `size` bytes.
+    `size` may be a string, as some drivers report it.
+
+    :returns: A (start, end) tuple of inclusive offsets, None if the whole
+              object should be sent, or False if the range can't be
+              satisfied.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or size is None:
+        # Multiple ranges and other units are optional, so they are
+        # answered with the whole object.
+        return None
+
+    size = int(size)
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # A suffix range, ex: the last 500 bytes.
+        if not int(last):
+            return False
+        return max(0, size - int(last)), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        # Invalid, so the header is ignored.
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last), size - 1) if last else size - 1
+
 
 class StorageController(base.BaseController):
     def resource_download(self, id, resource_id, filename=None):
@@ -20,12 +69,15 @@ class StorageController(base.BaseController):
         }
 
         try:
-            resource = logic.get_action('resource_show')(
-                context,
-                {
-                    'id': resource_id
-                }
-            )
+            if CloudStorage.fast_download_lookup.fget(None):
+                resource = self._get_download_resource(context, resource_id)
+            else:
+                resource = logic.get_action('resource_show')(
+                    context,
+                    {
+                        'id': resource_id
+                    }
+                )
         except logic.NotFound:
             base.abort(404, _('Resource not found'))
         except logic.NotAuthorized:
@@ -45,18 +97,183 @@ class StorageController(base.BaseController):
 
         upload = uploader.get_resource_uploader(resource)
 
+        if getattr(upload, 'stream_downloads', False):
+            return self._stream_download(upload, resource['id'], filename)
+
         # if the client requests with a Content-Type header (e.g. Text preview)
         # we have to add the header to the signature
         try:
             content_type = getattr(c.pylons.request, "content_type", None)
         except AttributeError:
             content_type = None
-        uploaded_url = upload.get_url_from_filename(resource['id'], filename,
-                                                    content_type=content_type)
+        if hasattr(upload, 'get_download_url'):
+            uploaded_url, max_age = upload.get_download_url(
+                resource['id'], filename, content_type=content_type)
+        else:
+            uploaded_url = upload.get_url_from_filename(
+                resource['id'], filename, content_type=content_type)
+            max_age = 0
 
         # The uploaded file is missing for some reason, such as the
         # provider being down.
         if uploaded_url is None:
+            self._abort_missing(upload, resource['id'], filename)
+
+        return self._cached_redirect(
+            uploaded_url,
+            max_age,
+            vary_content_type=bool(content_type)
+        )
+
+    def _abort_missing(self, upload, resource_id, filename):
+        """
+        Abort with a 503 if the resource's file is still waiting for a
+        background upload, otherwise with a 404.
+        """
+        # Sites not using background uploads may not have run `upgradedb`
+        # and have no table of pending uploads.
+        if not upload.background_upload:
             base.abort(404, _('No download is available'))
 
-        h.redirect_to(uploaded_url)
+        pending = model.Session.query(PendingUpload).get(resource_id)
+        if pending is not None and pending.status == u'pending':
+            # Check the provider again next time, the upload may be done.
+            missing_object_cache.pop(
+                upload.path_from_filename(resource_id, filename)
+            )
+            base.abort(
+                503,
+                _('The file is still being uploaded'),
+                headers={'Retry-After': '30'}
+            )
+        base.abort(404, _('No download is available'))
+
+    def _get_download_resource(self, context, resource_id):
+        """
+        Return the few fields of a resource a download needs, without
+        building the whole package dict like `resource_show`.
+
+        The `resource_show` auth check is still made, and its result cached
+        until the package or resource is modified, or for at most
+        `download_auth_cache_ttl` seconds.
+        """
+        row = model.Session.query(
+            model.Resource.id,
+            model.Resource.url,
+            model.Resource.url_type,
+            model.Resource.package_id,
+            model.Resource.last_modified,
+            model.Package.metadata_modified
+        ).join(
+            model.Package,
+            model.Package.id == model.Resource.package_id
+        ).filter(
+            model.Resource.id == resource_id,
+            model.Resource.state == 'active'
+        ).first()
+        if row is None:
+            raise logic.NotFound
+
+        cache_key = download_auth_key(
+            context,
+            row.id,
+            row.metadata_modified,
+            row.last_modified
+        )
+        if not download_auth_cache.get(cache_key):
+            logic.check_access('resource_show', context, {'id': row.id})
+            download_auth_cache.set(cache_key, True)
+
+        return {
+            'id': row.id,
+            'url': row.url,
+            'url_type': row.url_type,
+            'package_id': row.package_id
+        }
+
+    def _cached_redirect(self, url, max_age, vary_content_type=False):
+        """
+        Redirect to `url`, letting clients and proxies reuse the redirect
+        for `max_age` seconds and revalidate it with If-None-Match.
+        """
+        etag = hashlib.md5(url.encode('utf-8')).hexdigest()
+        if etag in request.if_none_match:
+            response.status = 304
+        else:
+            response.status = 302
+            response.headers['Location'] = url
+
+        response.headers['ETag'] = '"{0}"'.format(etag)
+        if vary_content_type:
+            response.headers['Vary'] = 'Content-Type'
+        if max_age > 0:
+            # Anonymous users can only see public resources, so their
+            # redirects are safe for shared caches to keep.
+            response.headers['Cache-Control'] = '{0}, max-age={1}'.format(
+                'private' if c.userobj else 'public', max_age
+            )
+            response.headers['Expires'] = formatdate(
+                time.time() + max_age, usegmt=True
+            )
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return ''
+
+    def _stream_download(self, upload, resource_id, filename):
+        """
+        Send the object's contents through CKAN, honouring Range and
+        If-None-Match request headers.
+        """
+        obj = upload.get_object(resource_id, filename)
+        if obj is None:
+            self._abort_missing(upload, resource_id, filename)
+
+        etag = None
+        if obj.hash:
+            etag = '"{0}"'.format(obj.hash.strip('"'))
+            if obj.hash.strip('"') in request.if_none_match:
+                response.status = 304
+                response.headers['ETag'] = etag
+                return ''
+
+        content_type = (
+            obj.extra.get('content_type') or
+            mimetypes.guess_type(filename)[0] or
+            'application/octet-stream'
+        )
+        # libcloud's S3 driver gives the Content-Length header as is.
+        size = int(obj.size) if obj.size is not None else None
+        byte_range = None
+        range_header = request.headers.get('Range')
+        if_range = request.headers.get('If-Range')
+        if range_header and (not if_range or if_range == etag):
+            byte_range = _parse_range(range_header, size)
+
+        if byte_range is False:
+            response.status = 416
+            response.headers['Content-Range'] = 'bytes */{0}'.format(size)
+            return ''
+
+        response.headers['Content-Type'] = content_type
+        response.headers['Accept-Ranges'] = 'bytes'
+        content_encoding = (
+            obj.extra.get('content_encoding') or
+            obj.meta_data.get('content-encoding')
+        )
+        if content_encoding:
+            response.headers['Content-Encoding'] = content_encoding
+        if etag:
+            response.headers['ETag'] = etag
+
+        if byte_range is None:
+            if size is not None:
+                response.headers['Content-Length'] = str(size)
+            return upload.iterate_object(obj)
+
+        start, end = byte_range
+        response.status = 206
+        response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            start, end, size
+        )
+        response.headers['Content-Length'] = str(end - start + 1)
+        return upload.iterate_object(obj, start=start, end=end)
@@ -4,6 +4,10 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
     return {
         options: {
             cloud: 'S3',
+            direct: false,
+            signBatchSize: 20,
+            concurrency: 4,
+            maxRetries: 3,
             i18n: {
                 resource_create: _('Resource has been created.'),
                 resource_update: _('Resource has been updated.'),
@@ -13,16 +17,17 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             }
         },
 
-        _partNumber: 1,
-
         _uploadId: null,
         _packageId: null,
         _resourceId: null,
         _uploadSize: null,
         _uploadName: null,
         _uploadedParts: null,
+        _uploadedPartNumbers: null,
         _clickedBtn: null,
         _redirect_url: null,
+        _etags: null,
+        _partUrls: null,
 
         initialize: function() {
             $.proxyAll(this, /_on/);
@@ -45,18 +50,12 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
             var self = this;
 
+            // File Upload is only used to pick the file; the chunks are
+            // sent by _onUploadParts so several can be in flight at once.
             this._file.fileupload({
-                url: this.sandbox.client.url('/api/action/cloudstorage_upload_multipart'),
                 maxChunkSize: 5 * 1024 * 1024,
                 replaceFileInput: false,
-                formData: this._onGenerateAdditionalData,
-                submit: this._onUploadFileSubmit,
-                chunkdone: this._onChunkUploaded,
-                add: this._onFileUploadAdd,
-                progressall: this._onFileUploadProgress,
-                done: this._onFinishUpload,
-                fail: this._onUploadFail,
-                always: this._onAnyEndedUpload
+                add: this._onFileUploadAdd
             });
 
             this._save.on('click', this._onSaveClick);
@@ -64,10 +63,6 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._onCheckExistingMultipart('choose');
         },
 
-        _onChunkUploaded: function () {
-            this._uploadedParts = this._partNumber++;
-        },
-
         _onCheckExistingMultipart: function (operation) {
             var self = this;
             var id = this._id.val();
@@ -84,13 +79,8 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                     self._uploadId = upload.id;
                     self._uploadSize = upload.size;
                     self._uploadedParts = upload.parts;
+                    self._uploadedPartNumbers = upload.part_numbers || [];
                     self._uploadName = upload.original_name;
-                    self._partNumber = self._uploadedParts + 1;
-
-
-                    var current_chunk_size = self._file.fileupload('option', 'maxChunkSize');
-                    var uploaded_bytes = current_chunk_size * upload.parts;
-                    self._file.fileupload('option', 'uploadedBytes', uploaded_bytes);
 
                     self.sandbox.notify(
                         'Incomplete upload',
@@ -142,49 +132,13 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
             this._onCheckExistingMultipart('resume');
         },
 
-        _onUploadFileSubmit: function (event, data) {
-            if (!this._uploadId) {
-                this._onDisableSave(false);
-                this.sandbox.notify(
-                    'Upload error',
-                    this.i18n('undefined_upload_id'),
-                    'error'
-                );
-                return false;
-            }
-
-            this._setProgressType('info', this._progress);
-            this._progress.show('slow');
-        },
-
-        _onGenerateAdditionalData: function (form) {
-            return [
-                {
-                    name: 'partNumber',
-                    value: this._partNumber
-                },
-                {
-                    name: 'uploadId',
-                    value: this._uploadId
-                },
-                {
-                    name: 'id',
-                    value: this._resourceId
-                }
-
-            ];
-        },
-
-        _onAnyEndedUpload: function () {
-            this._partNumber = 1;
-        },
-
         _countChunkSize: function (size, chunk) {
             while (size / chunk > 10000) chunk *= 2;
             return chunk;
         },
 
         _onFileUploadAdd: function (event, data) {
+            var self = this;
             this._setProgress(0, this._bar);
             var file = data.files[0];
             var target = $(event.target);
@@ -216,11 +170,6 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                 this._progress.show('slow');
                 this._onDisableResumeBtn();
                 this._save.trigger('click');
-
-                if (loaded >= file.size){
-                    this._onFinishUpload();
-                }
-
             }
 
 
@@ -228,10 +177,175 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
 
             this.el.off('multipartstarted.cloudstorage');
             this.el.on('multipartstarted.cloudstorage', function () {
-                data.submit();
+                self._onUploadParts(file, chunkSize);
+            });
+        },
+
+        _onUploadParts: function (file, chunkSize) {
+            var self = this;
+            if (!this._uploadId) {
+                this._onDisableSave(false);
+                this.sandbox.notify(
+                    'Upload error',
+                    this.i18n('undefined_upload_id'),
+                    'error'
+                );
+                return;
+            }
+
+            var total = Math.max(1, Math.ceil(file.size / chunkSize));
+            var queue = [];
+            var loaded = {};
+            var uploaded = this._uploadedPartNumbers || [];
+            for (var n = 1; n <= total; n++) {
+                if (!this.options.direct && $.inArray(n, uploaded) !== -1) {
+                    loaded[n] = Math.min(file.size, n * chunkSize) - (n - 1) * chunkSize;
+                } else {
+                    queue.push(n);
+                }
+            }
+
+            var running = 0;
+            var stopped = false;
+            this._etags = {};
+            this._partUrls = {};
+            this._setProgressType('info', this._progress);
+            this._progress.show('slow');
+
+            var onProgress = function (n, bytes) {
+                loaded[n] = bytes;
+                var sum = 0;
+                $.each(loaded, function (key, value) { sum += value; });
+                self._onFileUploadProgress(null, {total: file.size, loaded: sum});
+            };
+
+            // Keep up to `concurrency` parts in flight until the queue is
+            // empty, then commit the upload once the last one lands.
+            var next = function () {
+                if (stopped) return;
+                if (!queue.length) {
+                    if (!running) {
+                        stopped = true;
+                        self._onFinishUpload();
+                    }
+                    return;
+                }
+                var n = queue.shift();
+                running++;
+                self._onUploadPartWithRetry(file, chunkSize, n, queue, onProgress).then(
+                    function () {
+                        running--;
+                        next();
+                    },
+                    function () {
+                        // _onUploadFail reports the error and offers to
+                        // resume the upload.
+                        stopped = true;
+                        self._onUploadFail();
+                    }
+                );
+            };
+            for (var i = 0; i < this.options.concurrency; i++) {
+                next();
+            }
+        },
+
+        _onUploadPartWithRetry: function (file, chunkSize, n, queue, onProgress) {
+            var self = this;
+            var deferred = $.Deferred();
+            var attempt = 0;
+            var run = function () {
+                self._onUploadPart(file, chunkSize, n, queue, onProgress).then(
+                    deferred.resolve,
+                    function (err) {
+                        delete self._partUrls[n];
+                        onProgress(n, 0);
+                        if (++attempt > self.options.maxRetries) {
+                            deferred.reject(err);
+                            return;
+                        }
+                        setTimeout(run, 1000 * Math.pow(2, attempt));
+                    }
+                );
+            };
+            run();
+            return deferred.promise();
+        },
+
+        _onUploadPart: function (file, chunkSize, n, queue, onProgress) {
+            var self = this;
+            var start = (n - 1) * chunkSize;
+            var blob = file.slice(start, Math.min(file.size, start + chunkSize));
+            var xhr = function () {
+                var xhr = $.ajaxSettings.xhr();
+                if (xhr.upload) {
+                    xhr.upload.addEventListener('progress', function (event) {
+                        onProgress(n, event.loaded);
+                    });
+                }
+                return xhr;
+            };
+
+            if (!this.options.direct) {
+                var form = new FormData();
+                form.append('uploadId', this._uploadId);
+                form.append('partNumber', n);
+                form.append('id', this._resourceId);
+                form.append('upload', blob, file.name);
+                return $.ajax({
+                    method: 'POST',
+                    url: this.sandbox.client.url('/api/action/cloudstorage_upload_multipart'),
+                    data: form,
+                    processData: false,
+                    contentType: false,
+                    xhr: xhr
+                }).then(function () {
+                    onProgress(n, blob.size);
+                });
+            }
+
+            // The part goes straight to the provider; only its ETag comes
+            // back to CKAN, when the upload is finished.
+            return this._onSignPart(n, queue).then(function (url) {
+                return $.ajax({
+                    method: 'PUT',
+                    url: url,
+                    data: blob,
+                    processData: false,
+                    contentType: false,
+                    xhr: xhr
+                });
+            }).then(function (data, status, jqXHR) {
+                self._etags[n] = jqXHR.getResponseHeader('ETag');
+                onProgress(n, blob.size);
             });
         },
 
+        _onSignPart: function (n, queue) {
+            var self = this;
+            if (this._partUrls[n]) {
+                return this._partUrls[n];
+            }
+
+            // Sign this part along with the next few waiting in the queue.
+            var numbers = [n].concat(queue.slice(0, this.options.signBatchSize - 1));
+            var request = $.ajax({
+                method: 'POST',
+                url: this.sandbox.client.url('/api/action/cloudstorage_sign_multipart'),
+                data: JSON.stringify({
+                    id: this._resourceId,
+                    uploadId: this._uploadId,
+                    partNumbers: numbers
+                })
+            });
+            $.each(numbers, function (i, number) {
+                self._partUrls[number] = request.then(function (data) {
+                    return data.result.urls[i].url;
+                });
+            });
+            return this._partUrls[n];
+        },
+
         _onFileUploadProgress: function (event, data) {
             var progress = 100 / (data.total / data.loaded);
             this._setProgress(progress, this._bar);
@@ -367,6 +481,11 @@ ckan.module('cloudstorage-multipart-upload', function($, _) {
                 'uploadId': this._uploadId,
                 'id': this._resourceId,
                 'save_action': this._clickedBtn
+            };
+            if (this.options.direct) {
+                data_dict.parts = $.map(this._etags, function (etag, n) {
+                    return {partNumber: parseInt(n, 10), ETag: etag};
+                });
             }
             this.sandbox.client.call(
                 'POST',
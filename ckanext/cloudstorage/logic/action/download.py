@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os.path
+
+from ckan import logic
+import ckan.model as model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cloudstorage.model import CloudStorageObject
+from ckanext.cloudstorage.storage import (
+    ResourceCloudStorage,
+    download_auth_cache,
+    download_auth_key
+)
+
+# The most resources a single `cloudstorage_resource_urls` call returns.
+MAX_RESOURCE_URLS = 500
+# The most uploaded files a call may ask the provider about, one at a time,
+# when `check_object_exists` is on without the manifest.
+MAX_CHECKED_RESOURCE_URLS = 50
+
+
+def _authorized(context, rows):
+    """
+    Return the ids of the resources in `rows` the user may read, running
+    the `resource_show` auth check once per package and caching it like
+    downloads do.
+    """
+    allowed = set()
+    unchecked = {}
+    for resource, package in rows:
+        cache_key = download_auth_key(
+            context,
+            resource.id,
+            package.metadata_modified,
+            resource.last_modified
+        )
+        if download_auth_cache.get(cache_key):
+            allowed.add(resource.id)
+        else:
+            unchecked.setdefault(package.id, []).append(
+                (resource.id, cache_key)
+            )
+
+    for resources in unchecked.values():
+        try:
+            logic.check_access(
+                'resource_show',
+                dict(context),
+                {'id': resources[0][0]}
+            )
+        except logic.NotAuthorized:
+            continue
+        for resource_id, cache_key in resources:
+            download_auth_cache.set(cache_key, True)
+            allowed.add(resource_id)
+    return allowed
+
+
+def cloudstorage_resource_urls(context, data_dict):
+    """Download URLs of many resources at once, where the resources'
+    `/download` links would redirect to.
+
+    :param context:
+    :param data_dict: dict with required `ids` - list of resource ids,
+        at most 500, of which at most 50 uploaded files when their
+        existence is checked with the provider
+    :returns: dict of resource id to its URL: a public, CDN or signed URL
+        for uploaded files and the resource's `url` for links. The URL is
+        None if the resource doesn't exist, can't be read by the user or
+        its file is missing.
+    :rtype: dict
+
+    """
+
+    toolkit.check_access('cloudstorage_resource_urls', context, data_dict)
+    ids = toolkit.get_or_bust(data_dict, 'ids')
+    if isinstance(ids, basestring):
+        ids = ids.split(',')
+    if len(ids) > MAX_RESOURCE_URLS:
+        raise toolkit.ValidationError(
+            'At most %s resource URLs can be fetched at once'
+            % MAX_RESOURCE_URLS)
+
+    urls = dict((id, None) for id in ids)
+    # Packages are loaded with their resources, so checking whether one is
+    # private doesn't query it again.
+    rows = model.Session.query(model.Resource, model.Package).join(
+        model.Package,
+        model.Package.id == model.Resource.package_id
+    ).filter(
+        model.Resource.id.in_(ids),
+        model.Resource.state == 'active'
+    ).all()
+    allowed = _authorized(context, rows)
+
+    files = []
+    for resource, package in rows:
+        if resource.id not in allowed:
+            continue
+        if resource.url_type != 'upload':
+            urls[resource.id] = resource.url or None
+            continue
+        uploader = ResourceCloudStorage({
+            'id': resource.id,
+            'package_id': package.id
+        })
+        files.append((
+            uploader,
+            resource.id,
+            os.path.basename(resource.url)
+        ))
+
+    if len(files) > MAX_CHECKED_RESOURCE_URLS:
+        uploader = files[0][0]
+        if uploader.check_object_exists and not uploader.use_manifest:
+            raise toolkit.ValidationError(
+                'At most %s uploaded files can be checked at once'
+                % MAX_CHECKED_RESOURCE_URLS)
+
+    objects = []
+    if files and files[0][0].use_manifest:
+        # Look up every object in one query. While they are referenced the
+        # session answers the per-file manifest checks.
+        objects = model.Session.query(CloudStorageObject).filter(
+            CloudStorageObject.key.in_([
+                uploader.path_from_filename(rid, filename)
+                for uploader, rid, filename in files
+            ])
+        ).all()
+
+    for uploader, rid, filename in files:
+        urls[rid] = uploader.get_url_from_filename(rid, filename)
+    # The manifest rows only had to outlive the loop above.
+    del objects
+    return urls
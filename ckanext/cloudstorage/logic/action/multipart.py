@@ -1,20 +1,49 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
+import hashlib
 import logging
 import datetime
+import mimetypes
+import time
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 from pylons import config
-from sqlalchemy.orm.exc import NoResultFound
+from libcloud.storage.types import ObjectDoesNotExistError
+from sqlalchemy import and_, inspect
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.exc import MultipleResultsFound
 import ckan.model as model
 import ckan.lib.helpers as h
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.cloudstorage.storage import ResourceCloudStorage
-from ckanext.cloudstorage.model import MultipartUpload, MultipartPart
+from ckanext.cloudstorage import signing, stats
+from ckanext.cloudstorage.storage import (
+    CloudStorage,
+    ResourceCloudStorage,
+    missing_object_cache
+)
+from ckanext.cloudstorage.model import (
+    CloudStorageObject,
+    MultipartUpload,
+    MultipartPart
+)
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
 
 log = logging.getLogger(__name__)
 
+# Whether the parts table has been re-keyed on (upload_id, n) by
+# `upgradedb`, checked once per process.
+_part_key = {}
+
+# The most part URLs signed by a single `sign_multipart` call.
+MAX_SIGNED_PARTS = 100
+# How much of a part is held in memory at once while proxying it.
+PART_BUFFER_SIZE = 64 * 1024
+# How many expired uploads are aborted before their rows are committed.
+CLEAN_BATCH_SIZE = 500
+
 
 def _get_underlying_file(wrapper):
     if isinstance(wrapper, FlaskFileStorage):
@@ -31,11 +60,88 @@ def _get_object_url(uploader, name):
     return '/' + uploader.container_name + '/' + name
 
 
+def _sign_part_url(uploader, upload, part_number, expires_in, now):
+    with stats.timed('sign_url'):
+        return signing.presign_s3(
+            uploader.driver.connection.host,
+            uploader.container_name,
+            upload.name,
+            uploader.driver_options['key'],
+            uploader.driver_options['secret'],
+            uploader.region,
+            expires_in,
+            token=uploader.driver_options.get('token'),
+            now=now,
+            method='PUT',
+            params={'partNumber': part_number, 'uploadId': upload.id}
+        )
+
+
+def _initiate_upload(uploader, name, headers=None):
+    with stats.timed('initiate_multipart'):
+        resp = uploader.driver.connection.request(
+            _get_object_url(uploader, name) + '?uploads',
+            method='POST',
+            headers=headers
+        )
+    if not resp.success():
+        raise toolkit.ValidationError(resp.error)
+    try:
+        upload_id = resp.object.find(
+            '{%s}UploadId' % resp.object.nsmap[None]).text
+    except AttributeError:
+        upload_id_list = filter(
+            lambda e: e.tag.endswith('UploadId'),
+            resp.object.getchildren()
+        )
+        upload_id = upload_id_list[0].text
+    return upload_id
+
+
+def _get_part_url(uploader, name, upload_id, part_number):
+    return _get_object_url(
+        uploader, name) + '?partNumber={0}&uploadId={1}'.format(
+            part_number, upload_id)
+
+
+def _read_in_buffers(stream):
+    stream.seek(0)
+    return iter(lambda: stream.read(PART_BUFFER_SIZE), b'')
+
+
+def _stream_part(uploader, request_path, stream, headers=None,
+                 operation='upload_part'):
+    # The Content-MD5 header has to be sent before the body, so the digest
+    # is computed in a first buffered pass over the spooled part.
+    md5 = hashlib.md5()
+    for buf in _read_in_buffers(stream):
+        md5.update(buf)
+    size = stream.tell()
+
+    headers = dict(headers or {})
+    headers.update({
+        'Content-Length': str(size),
+        'Content-MD5': base64.b64encode(md5.digest())
+    })
+    connection = uploader.driver.connection
+    with stats.timed(operation, size):
+        resp = connection.request(
+            request_path,
+            method='PUT',
+            headers=headers,
+            raw=True
+        )
+        for buf in _read_in_buffers(stream):
+            connection.connection.send(buf)
+    return resp
+
+
 def _delete_multipart(upload, uploader):
-    resp = uploader.driver.connection.request(
-        _get_object_url(uploader, upload.name) + '?uploadId=' + upload.id,
-        method='DELETE'
-    )
+    with stats.timed('abort_multipart'):
+        resp = uploader.driver.connection.request(
+            _get_object_url(uploader, upload.name) + '?uploadId=' + upload.id,
+            method='DELETE'
+        )
     if not resp.success():
         raise toolkit.ValidationError(resp.error)
 
@@ -44,17 +150,151 @@ def _delete_multipart(upload, uploader):
     return resp
 
 
-def _save_part_info(n, etag, upload):
+def _abort_upload(item):
+    # Runs in a worker thread, so it must use that thread's own driver.
+    name, upload_id = item
+    uploader = CloudStorage()
     try:
-        part = model.Session.query(MultipartPart).filter(
-            MultipartPart.n == n,
-            MultipartPart.upload == upload).one()
-    except NoResultFound:
-        part = MultipartPart(n, etag, upload)
+        with stats.timed('abort_multipart'):
+            resp = uploader.driver.connection.request(
+                _get_object_url(uploader, name) + '?uploadId=' + upload_id,
+                method='DELETE'
+            )
+    except Exception as e:
+        return upload_id, str(e)
+    # An upload the provider no longer knows about is as good as aborted.
+    if resp.success() or resp.status == 404:
+        return upload_id, None
+    return upload_id, resp.error
+
+
+def _abort_uploads(uploads, workers):
+    """Abort (name, upload id) pairs concurrently.
+
+    :returns: iterator of (upload id, error or None) tuples
+    """
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(_abort_upload, uploads):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _iterate_orphaned_uploads(uploader, oldest_allowed):
+    """Yield (name, upload id) of expired uploads that exist at the
+    provider but have no MultipartUpload row."""
+    driver = uploader.driver
+    if not getattr(driver, 'supports_s3_multipart_upload', False):
+        return
+
+    # Uploads are listed a page at a time by the driver.
+    for upload in driver.ex_iterate_multipart_uploads(
+            uploader.container, prefix=uploader.resources_prefix):
+        initiated = datetime.datetime.strptime(
+            upload.created_at[:19], '%Y-%m-%dT%H:%M:%S')
+        if initiated >= oldest_allowed:
+            continue
+        if model.Session.query(MultipartUpload).get(upload.id) is None:
+            yield upload.key, upload.id
+
+
+def _clean_expired(uploader, oldest_allowed, orphans=False, workers=None):
+    result = {
+        'removed': 0,
+        'total': 0,
+        'errors': [],
+        'orphans': 0
+    }
+    workers = workers or uploader.delete_workers
+
+    expired = [
+        (name, upload_id)
+        for name, upload_id in model.Session.query(
+            MultipartUpload.name, MultipartUpload.id
+        ).filter(MultipartUpload.initiated < oldest_allowed)
+    ]
+    result['total'] = len(expired)
+
+    aborted = _abort_uploads(expired, workers)
+    while True:
+        batch = list(islice(aborted, CLEAN_BATCH_SIZE))
+        if not batch:
+            break
+        removed = [upload_id for upload_id, error in batch if error is None]
+        result['errors'].extend(error for _, error in batch if error)
+        if removed:
+            model.Session.query(MultipartPart).filter(
+                MultipartPart.upload_id.in_(removed)
+            ).delete(synchronize_session=False)
+            model.Session.query(MultipartUpload).filter(
+                MultipartUpload.id.in_(removed)
+            ).delete(synchronize_session=False)
+            model.Session.commit()
+        result['removed'] += len(removed)
+
+    if orphans:
+        # Listed up front, so the provider and database are only used from
+        # this thread.
+        orphaned = list(_iterate_orphaned_uploads(uploader, oldest_allowed))
+        for upload_id, error in _abort_uploads(orphaned, workers):
+            if error:
+                result['errors'].append(error)
+            else:
+                result['orphans'] += 1
+
+    return result
+
+
+def _save_parts(upload, parts):
+    """Record the ETags of several parts in a single upsert.
+
+    :param upload: the MultipartUpload the parts belong to
+    :param parts: iterable of (part number, etag) tuples
+    """
+    values = [
+        {'upload_id': upload.id, 'n': int(n), 'etag': etag}
+        for n, etag in parts
+    ]
+    if not values:
+        return
+    table = MultipartPart.__table__
+    if _parts_rekeyed():
+        statement = insert(table).values(values)
+        model.Session.execute(statement.on_conflict_do_update(
+            index_elements=['upload_id', 'n'],
+            set_={'etag': statement.excluded.etag}
+        ))
     else:
-        part.etag = etag
-    part.save()
-    return part
+        # Without the (upload_id, n) key there's nothing for an upsert to
+        # conflict on, so each part is updated or else inserted.
+        for value in values:
+            updated = model.Session.execute(table.update().where(and_(
+                table.c.upload_id == value['upload_id'],
+                table.c.n == value['n']
+            )).values(etag=value['etag'])).rowcount
+            if not updated:
+                model.Session.execute(table.insert().values(value))
+    model.Session.commit()
+
+
+def _parts_rekeyed():
+    if 'rekeyed' not in _part_key:
+        pk = inspect(model.meta.engine).get_pk_constraint(
+            MultipartPart.__tablename__
+        )
+        _part_key['rekeyed'] = pk['constrained_columns'] == ['upload_id', 'n']
+        if not _part_key['rekeyed']:
+            log.warning(
+                'The multipart parts table predates this version, run'
+                ' `paster cloudstorage upgradedb` to upgrade it.'
+            )
+    return _part_key['rekeyed']
+
+
+def _save_part_info(n, etag, upload):
+    _save_parts(upload, [(n, etag)])
 
 
 def check_multipart(context, data_dict):
@@ -62,21 +302,29 @@ def check_multipart(context, data_dict):
 
     :param context:
     :param data_dict: dict with required `id`
-    :returns: None or dict with `upload` - existing multipart upload info
+    :returns: None or dict with `upload` - existing multipart upload info,
+        including `part_numbers` - the parts already uploaded
     :rtype: NoneType or dict
 
     """
 
     h.check_access('cloudstorage_check_multipart', data_dict)
     id = toolkit.get_or_bust(data_dict, 'id')
-    try:
-        upload = model.Session.query(MultipartUpload).filter_by(
-            resource_id=id).one()
-    except NoResultFound:
+    # The upload and its part numbers are fetched in one query.
+    rows = model.Session.query(MultipartUpload, MultipartPart.n).outerjoin(
+        MultipartPart, MultipartPart.upload_id == MultipartUpload.id
+    ).filter(
+        MultipartUpload.resource_id == id
+    ).order_by(MultipartPart.n).all()
+    if not rows:
         return
-    upload_dict = upload.as_dict()
-    upload_dict['parts'] = model.Session.query(MultipartPart).filter(
-        MultipartPart.upload == upload).count()
+    if len(set(upload for upload, _ in rows)) > 1:
+        raise MultipleResultsFound(
+            'Multiple uploads found for resource %s' % id)
+
+    upload_dict = rows[0][0].as_dict()
+    upload_dict['part_numbers'] = [n for _, n in rows if n is not None]
+    upload_dict['parts'] = len(upload_dict['part_numbers'])
     return {'upload': upload_dict}
 
 
@@ -100,7 +348,11 @@ def initiate_multipart(context, data_dict):
     if context['auth_user_obj']:
         user_id = context['auth_user_obj'].id
 
-    uploader = ResourceCloudStorage({'multipart_name': name})
+    resource = model.Resource.get(id)
+    uploader = ResourceCloudStorage({
+        'multipart_name': name,
+        'package_id': resource.package_id if resource else None
+    })
     res_name = uploader.path_from_filename(id, name)
 
     upload_object = MultipartUpload.by_name(res_name)
@@ -114,32 +366,20 @@ def initiate_multipart(context, data_dict):
                 resource_id=id):
             _delete_multipart(old_upload, uploader)
 
-        _rindex = res_name.rfind('/')
-        if ~_rindex:
-            try:
-                name_prefix = res_name[:_rindex]
-                for cloud_object in uploader.container.iterate_objects():
-                    if cloud_object.name.startswith(name_prefix):
-                        log.info('Removing cloud object: %s' % cloud_object)
-                        cloud_object.delete()
-            except Exception as e:
-                log.exception('[delete from cloud] %s' % e)
-
-        resp = uploader.driver.connection.request(
-            _get_object_url(uploader, res_name) + '?uploads',
-            method='POST'
-        )
-        if not resp.success():
-            raise toolkit.ValidationError(resp.error)
         try:
-            upload_id = resp.object.find(
-                '{%s}UploadId' % resp.object.nsmap[None]).text
-        except AttributeError:
-            upload_id_list = filter(
-                lambda e: e.tag.endswith('UploadId'),
-                resp.object.getchildren()
+            removed = uploader.delete_objects(
+                uploader.iterate_resource_objects(id)
             )
-            upload_id = upload_id_list[0].text
+            log.info('Removed %s cloud objects of resource %s' % (
+                removed, id))
+        except Exception as e:
+            log.exception('[delete from cloud] %s' % e)
+
+        upload_id = _initiate_upload(
+            uploader,
+            res_name,
+            headers=uploader.object_headers(uploader.object_metadata(name))
+        )
         upload_object = MultipartUpload(upload_id, id, res_name, size, name, user_id)
 
         upload_object.save()
@@ -154,12 +394,10 @@ def upload_multipart(context, data_dict):
     uploader = ResourceCloudStorage({})
     upload = model.Session.query(MultipartUpload).get(upload_id)
 
-    resp = uploader.driver.connection.request(
-        _get_object_url(
-            uploader, upload.name) + '?partNumber={0}&uploadId={1}'.format(
-                part_number, upload_id),
-        method='PUT',
-        data=bytearray(_get_underlying_file(part_content).read())
+    resp = _stream_part(
+        uploader,
+        _get_part_url(uploader, upload.name, upload_id, part_number),
+        _get_underlying_file(part_content)
     )
     if resp.status != 200:
         raise toolkit.ValidationError('Upload failed: part %s' % part_number)
@@ -171,6 +409,58 @@ def upload_multipart(context, data_dict):
     }
 
 
+def sign_multipart(context, data_dict):
+    """Sign URLs the browser can PUT multipart chunks to directly.
+
+    :param context:
+    :param data_dict: dict with required keys:
+        id: resource's id
+        uploadId: id of the Multipart Upload
+        partNumbers: list of part numbers to sign, at most 100
+    :returns: dict with `urls` - list of dicts with `partNumber` and `url`
+    :rtype: dict
+
+    """
+
+    toolkit.check_access('cloudstorage_sign_multipart', context, data_dict)
+    id, upload_id, part_numbers = toolkit.get_or_bust(
+        data_dict, ['id', 'uploadId', 'partNumbers'])
+    if not isinstance(part_numbers, list):
+        part_numbers = [part_numbers]
+    if len(part_numbers) > MAX_SIGNED_PARTS:
+        raise toolkit.ValidationError(
+            'At most %s parts can be signed at once' % MAX_SIGNED_PARTS)
+    try:
+        part_numbers = [int(n) for n in part_numbers]
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError('partNumbers must be integers')
+
+    uploader = ResourceCloudStorage({})
+    if 'S3' not in uploader.driver_name:
+        raise toolkit.ValidationError(
+            'Direct uploads are not supported by %s' % uploader.driver_name)
+
+    upload = model.Session.query(MultipartUpload).get(upload_id)
+    # The auth check only covers the resource, so the upload must be one of
+    # its own.
+    if upload is None or upload.resource_id != id:
+        raise toolkit.ObjectNotFound('Multipart upload not found')
+
+    # Every part is signed at the same time, for the same lifetime.
+    now = time.time()
+    return {
+        'urls': [
+            {
+                'partNumber': n,
+                'url': _sign_part_url(
+                    uploader, upload, n, uploader.secure_url_lifetime, now
+                )
+            }
+            for n in part_numbers
+        ]
+    }
+
+
 def finish_multipart(context, data_dict):
     """Called after all parts had been uploaded.
 
@@ -179,6 +469,8 @@ def finish_multipart(context, data_dict):
 
     :param context:
     :param data_dict: dict with required key `uploadId` - id of Multipart Upload that should be finished
+        and optional `parts` - list of dicts with `partNumber` and `ETag` of
+        the parts uploaded directly to the provider
     :returns: None
     :rtype: NoneType
 
@@ -188,6 +480,10 @@ def finish_multipart(context, data_dict):
     upload_id = toolkit.get_or_bust(data_dict, 'uploadId')
     save_action = data_dict.get('save_action', False)
     upload = model.Session.query(MultipartUpload).get(upload_id)
+    _save_parts(upload, [
+        (part['partNumber'], part['ETag'])
+        for part in data_dict.get('parts') or []
+    ])
     chunks = [
         (part.n, part.etag)
         for part in model.Session.query(MultipartPart).filter_by(
@@ -195,14 +491,23 @@ def finish_multipart(context, data_dict):
     ]
     uploader = ResourceCloudStorage({})
     try:
-        obj = uploader.container.get_object(upload.name)
-        obj.delete()
+        with stats.timed('get_object', expected=ObjectDoesNotExistError):
+            obj = uploader.container.get_object(upload.name)
+        with stats.timed('delete_object'):
+            obj.delete()
     except Exception:
         pass
-    uploader.driver._commit_multipart(
-        _get_object_url(uploader, upload.name),
-        upload_id,
-        chunks)
+    with stats.timed('commit_multipart'):
+        etag = uploader.driver._commit_multipart(
+            _get_object_url(uploader, upload.name),
+            upload_id,
+            chunks)
+    missing_object_cache.pop(upload.name)
+    if uploader.use_manifest:
+        CloudStorageObject.record(
+            upload.name, upload.resource_id, size=upload.size, etag=etag,
+            content_type=mimetypes.guess_type(upload.original_name)[0],
+            commit=False)
     upload.delete()
     upload.commit()
 
@@ -244,37 +549,25 @@ def clean_multipart(context, data_dict):
     """Clean old multipart uploads.
 
     :param context:
-    :param data_dict:
+    :param data_dict: dict with optional `orphans` - also abort expired
+        uploads that exist at the provider but are unknown to CKAN.
     :returns: dict with:
         removed - amount of removed uploads.
         total - total amount of expired uploads.
         errors - list of errors raised during deletion. Appears when
         `total` and `removed` are different.
+        orphans - amount of aborted uploads unknown to CKAN.
     :rtype: dict
 
     """
 
-    h.check_access('cloudstorage_clean_multipart', data_dict)
+    toolkit.check_access('cloudstorage_clean_multipart', context, data_dict)
     uploader = ResourceCloudStorage({})
     delta = _get_max_multipart_lifetime()
     oldest_allowed = datetime.datetime.utcnow() - delta
 
-    uploads_to_remove = model.Session.query(MultipartUpload).filter(
-        MultipartUpload.initiated < oldest_allowed
+    return _clean_expired(
+        uploader,
+        oldest_allowed,
+        orphans=toolkit.asbool(data_dict.get('orphans', False))
     )
-
-    result = {
-        'removed': 0,
-        'total': uploads_to_remove.count(),
-        'errors': []
-    }
-
-    for upload in uploads_to_remove:
-        try:
-            _delete_multipart(upload, uploader)
-        except toolkit.ValidationError as e:
-            result['errors'].append(e.error_summary)
-        else:
-            result['removed'] += 1
-
-    return result
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.cloudstorage import stats
+from ckanext.cloudstorage.storage import (
+    download_auth_cache,
+    missing_object_cache,
+    secure_url_cache
+)
+
+
+def cloudstorage_stats(context, data_dict):
+    """Timings and counters of the provider calls made by this process.
+
+    :param context:
+    :param data_dict: dict with optional `reset` - clear the counters after
+        reading them.
+    :returns: dict with:
+        buckets_ms - upper bounds of the latency histogram buckets, the
+        last bucket counting anything slower.
+        operations - dict of operation name to `count`, `errors`, `bytes`,
+        `total_ms`, `max_ms` and `histogram`.
+        caches - hit and miss counters of the URL and download auth
+        caches.
+    :rtype: dict
+
+    """
+
+    toolkit.check_access('cloudstorage_stats', context, data_dict)
+    result = stats.snapshot()
+    result['caches'] = {
+        'secure_url': secure_url_cache.stats(),
+        'missing_object': missing_object_cache.stats(),
+        'download_auth': download_auth_cache.stats()
+    }
+    if toolkit.asbool(data_dict.get('reset', False)):
+        stats.reset()
+    return result
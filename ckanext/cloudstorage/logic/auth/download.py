@@ -0,0 +1,9 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import ckan.plugins.toolkit as toolkit
+
+
+@toolkit.auth_allow_anonymous_access
+def cloudstorage_resource_urls(context, data_dict):
+    # Each resource is checked with `resource_show` by the action.
+    return {'success': True}
@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+def cloudstorage_stats(context, data_dict):
+    return {'success': False}
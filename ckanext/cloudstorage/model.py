@@ -4,10 +4,13 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
 import ckan.model as model
 from sqlalchemy import (
+    inspect,
     Column,
+    PrimaryKeyConstraint,
     UnicodeText,
     DateTime,
     ForeignKey,
+    BigInteger,
     Integer,
     Numeric
 )
@@ -19,6 +22,14 @@ Base = declarative_base()
 metadata = Base.metadata
 
 
+def unquote_etag(etag):
+    """
+    Return `etag` without the quotes some providers and drivers keep
+    around it, so ETags from every source compare equal.
+    """
+    return etag.strip('"') if etag else etag
+
+
 def drop_tables():
     metadata.drop_all(model.meta.engine)
 
@@ -27,19 +38,64 @@ def create_tables():
     metadata.create_all(model.meta.engine)
 
 
+def upgrade_tables():
+    """
+    Bring tables created by an older version up to date without losing
+    data: create new tables, add missing columns and indexes and re-key
+    multipart parts on (upload_id, n).
+    """
+    engine = model.meta.engine
+    metadata.create_all(engine)
+    inspector = inspect(engine)
+
+    for table in metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                engine.execute('ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                    table.name,
+                    column.name,
+                    column.type.compile(engine.dialect)
+                ))
+
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+    part_table = MultipartPart.__tablename__
+    pk = inspector.get_pk_constraint(part_table)
+    if pk['constrained_columns'] != ['upload_id', 'n']:
+        with engine.begin() as connection:
+            # Older versions could store a part more than once with
+            # different ETags; keep one row per part before re-keying.
+            connection.execute(
+                'DELETE FROM {0} a USING {0} b'
+                ' WHERE a.upload_id = b.upload_id AND a.n = b.n'
+                ' AND a.etag < b.etag'.format(part_table)
+            )
+            connection.execute('ALTER TABLE {0} DROP CONSTRAINT {1}'.format(
+                part_table, pk['name']))
+            connection.execute(
+                'ALTER TABLE {0} ADD PRIMARY KEY (upload_id, n)'.format(
+                    part_table))
+
+
 class MultipartPart(Base, DomainObject):
     __tablename__ = 'cloudstorage_multipart_part'
+    __table_args__ = (
+        PrimaryKeyConstraint('upload_id', 'n'),
+    )
 
     def __init__(self, n, etag, upload):
         self.n = n
         self.etag = etag
         self.upload = upload
 
-    n = Column(Integer, primary_key=True)
-    etag = Column(UnicodeText, primary_key=True)
+    n = Column(Integer)
+    etag = Column(UnicodeText)
     upload_id = Column(
-        UnicodeText, ForeignKey('cloudstorage_multipart_upload.id'),
-        primary_key=True
+        UnicodeText, ForeignKey('cloudstorage_multipart_upload.id')
     )
     upload = relationship(
         'MultipartUpload',
@@ -66,9 +122,111 @@ class MultipartUpload(Base, DomainObject):
         return query
 
     id = Column(UnicodeText, primary_key=True)
-    resource_id = Column(UnicodeText)
+    resource_id = Column(UnicodeText, index=True)
     name = Column(UnicodeText)
-    initiated = Column(DateTime, default=datetime.utcnow)
+    initiated = Column(DateTime, default=datetime.utcnow, index=True)
     size = Column(Numeric)
     original_name = Column(UnicodeText)
     user_id = Column(UnicodeText)
+
+
+class CloudStorageObject(Base, DomainObject):
+    """
+    A manifest of every object ckanext-cloudstorage has written, so that
+    existence checks and cleanups don't need to ask the provider.
+    """
+    __tablename__ = 'cloudstorage_object'
+
+    def __init__(self, key, resource_id, size=None, etag=None,
+                 content_type=None, content_encoding=None,
+                 content_hash=None):
+        self.key = key
+        self.resource_id = resource_id
+        self.size = size
+        self.etag = unquote_etag(etag)
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.content_hash = content_hash
+
+    @classmethod
+    def record(cls, key, resource_id, size=None, etag=None,
+               content_type=None, content_encoding=None, content_hash=None,
+               commit=True):
+        """
+        Add or replace the manifest entry for `key`.
+        """
+        obj = meta.Session.merge(cls(
+            key, resource_id, size, etag, content_type, content_encoding,
+            content_hash
+        ))
+        obj.uploaded = datetime.utcnow()
+        if commit:
+            meta.Session.commit()
+        return obj
+
+    @classmethod
+    def forget(cls, keys, commit=True):
+        """
+        Remove the manifest entries for every key in `keys`.
+        """
+        keys = list(keys)
+        if keys:
+            meta.Session.query(cls).filter(
+                cls.key.in_(keys)
+            ).delete(synchronize_session=False)
+        if commit:
+            meta.Session.commit()
+
+    @classmethod
+    def resource_objects(cls, resource_id):
+        query = meta.Session.query(cls).filter_by(
+            resource_id=resource_id
+        )
+        return query
+
+    @classmethod
+    def find_by_hash(cls, content_hash, content_type, prefer_key=None):
+        """
+        Return an entry whose uploaded contents had the SHA-256 digest
+        `content_hash` and the same content type, preferring `prefer_key`,
+        or None.
+        """
+        return meta.Session.query(cls).filter_by(
+            content_hash=content_hash,
+            content_type=content_type
+        ).order_by(
+            (cls.key == prefer_key).desc()
+        ).first()
+
+    key = Column(UnicodeText, primary_key=True)
+    resource_id = Column(UnicodeText, index=True)
+    size = Column(BigInteger)
+    etag = Column(UnicodeText)
+    content_type = Column(UnicodeText)
+    content_encoding = Column(UnicodeText)
+    # SHA-256 of the contents as uploaded, before any compression.
+    content_hash = Column(UnicodeText, index=True)
+    uploaded = Column(DateTime, default=datetime.utcnow)
+
+
+class PendingUpload(Base, DomainObject):
+    """
+    A resource file spooled to local disk, waiting for a background worker
+    to send it to the provider.
+    """
+    __tablename__ = 'cloudstorage_pending_upload'
+
+    def __init__(self, resource_id, filename, spool_path):
+        self.resource_id = resource_id
+        self.filename = filename
+        self.spool_path = spool_path
+        self.status = u'pending'
+        self.attempts = 0
+
+    resource_id = Column(UnicodeText, primary_key=True)
+    filename = Column(UnicodeText)
+    spool_path = Column(UnicodeText)
+    status = Column(UnicodeText)
+    attempts = Column(Integer)
+    error = Column(UnicodeText)
+    queued = Column(DateTime, default=datetime.utcnow)
@@ -2,11 +2,14 @@
 # -*- coding: utf-8 -*-
 from ckan import plugins
 from routes.mapper import SubMapper
-import os.path
 from ckanext.cloudstorage import storage
 from ckanext.cloudstorage import helpers
 import ckanext.cloudstorage.logic.action.multipart as m_action
 import ckanext.cloudstorage.logic.auth.multipart as m_auth
+import ckanext.cloudstorage.logic.action.stats as s_action
+import ckanext.cloudstorage.logic.auth.stats as s_auth
+import ckanext.cloudstorage.logic.action.download as d_action
+import ckanext.cloudstorage.logic.auth.download as d_auth
 
 
 class CloudStoragePlugin(plugins.SingletonPlugin):
@@ -29,7 +32,10 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
 
     def get_helpers(self):
         return dict(
-            cloudstorage_use_secure_urls=helpers.use_secure_urls
+            cloudstorage_use_secure_urls=helpers.use_secure_urls,
+            cloudstorage_use_direct_multipart_upload=(
+                helpers.use_direct_multipart_upload
+            )
         )
 
     def configure(self, config):
@@ -48,6 +54,9 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
                     )
                 )
 
+        # Parse the options once rather than on every uploader instance.
+        storage.configure(config)
+
     def get_resource_uploader(self, data_dict):
         # We provide a custom Resource uploader.
         return storage.ResourceCloudStorage(data_dict)
@@ -85,10 +94,15 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
         return {
             'cloudstorage_initiate_multipart': m_action.initiate_multipart,
             'cloudstorage_upload_multipart': m_action.upload_multipart,
+            'cloudstorage_sign_multipart': m_action.sign_multipart,
             'cloudstorage_finish_multipart': m_action.finish_multipart,
             'cloudstorage_abort_multipart': m_action.abort_multipart,
             'cloudstorage_check_multipart': m_action.check_multipart,
             'cloudstorage_clean_multipart': m_action.clean_multipart,
+            'cloudstorage_stats': s_action.cloudstorage_stats,
+            'cloudstorage_resource_urls': (
+                d_action.cloudstorage_resource_urls
+            ),
         }
 
     # IAuthFunctions
@@ -97,10 +111,13 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
         return {
             'cloudstorage_initiate_multipart': m_auth.initiate_multipart,
             'cloudstorage_upload_multipart': m_auth.upload_multipart,
+            'cloudstorage_sign_multipart': m_auth.sign_multipart,
             'cloudstorage_finish_multipart': m_auth.finish_multipart,
             'cloudstorage_abort_multipart': m_auth.abort_multipart,
             'cloudstorage_check_multipart': m_auth.check_multipart,
             'cloudstorage_clean_multipart': m_auth.clean_multipart,
+            'cloudstorage_stats': s_auth.cloudstorage_stats,
+            'cloudstorage_resource_urls': d_auth.cloudstorage_resource_urls,
         }
 
     # IResourceController
@@ -136,13 +153,6 @@ class CloudStoragePlugin(plugins.SingletonPlugin):
 
         # and all other files linked to this resource
         if not uploader.leave_files:
-            upload_path = os.path.dirname(
-                uploader.path_from_filename(
-                    resource['id'],
-                    'fake-name'
-                )
+            uploader.delete_objects(
+                uploader.iterate_resource_objects(resource['id'])
             )
-
-            for old_file in uploader.container.iterate_objects():
-                if old_file.name.startswith(upload_path):
-                    old_file.delete()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import hmac
+import threading
+import time
+import urllib
+
+# The most seconds a SigV4 presigned URL may be valid for.
+MAX_S3_EXPIRES = 7 * 24 * 60 * 60
+AZURE_SAS_VERSION = '2018-11-09'
+
+_lock = threading.Lock()
+# SigV4 signing keys, keyed by (secret, date, region). They are only
+# good for the day they were derived for.
+_s3_keys = {}
+# Decoded Azure account keys, keyed by the base64 encoded key.
+_azure_keys = {}
+
+
+def _quote(value, safe='~'):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return urllib.quote(value, safe=safe)
+
+
+def _s3_signing_key(secret, date, region):
+    cache_key = (secret, date, region)
+    key = _s3_keys.get(cache_key)
+    if key is None:
+        key = ('AWS4' + secret).encode('utf-8')
+        for part in (date, region, 's3', 'aws4_request'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        key = hmac.new(key, digestmod=hashlib.sha256)
+        with _lock:
+            for stale in [k for k in _s3_keys if k[1] != date]:
+                del _s3_keys[stale]
+            _s3_keys[cache_key] = key
+    return key.copy()
+
+
+def _azure_signing_key(secret):
+    key = _azure_keys.get(secret)
+    if key is None:
+        key = hmac.new(base64.b64decode(secret), digestmod=hashlib.sha256)
+        with _lock:
+            _azure_keys[secret] = key
+    return key.copy()
+
+
+def presign_s3(host, bucket, path, access_key, secret, region, expires_in,
+               content_type=None, token=None, now=None, method='GET',
+               params=None):
+    """
+    Return a path-style SigV4 presigned URL for the object at `path`.
+
+    :param host: The S3 endpoint, ex: `s3.amazonaws.com`.
+    :param expires_in: How many seconds the URL is valid for, at most 7
+                       days.
+    :param content_type: Optionally a Content-Type header the client must
+                         send with the request.
+    :param token: Optionally the session token of temporary credentials.
+    :param now: Optionally the unix time to sign at, defaults to now.
+    :param method: The HTTP method the URL is for.
+    :param params: Optionally a dict of extra query parameters to sign,
+                   ex: the `partNumber` and `uploadId` of a multipart part.
+    """
+    amz_date = time.strftime(
+        '%Y%m%dT%H%M%SZ',
+        time.gmtime(time.time() if now is None else now)
+    )
+    date = amz_date[:8]
+    scope = '{0}/{1}/s3/aws4_request'.format(date, region)
+
+    headers = {'host': host}
+    if content_type:
+        headers['content-type'] = content_type
+    signed_headers = ';'.join(sorted(headers))
+
+    params = dict(params or {})
+    params.update({
+        'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+        'X-Amz-Credential': '{0}/{1}'.format(access_key, scope),
+        'X-Amz-Date': amz_date,
+        'X-Amz-Expires': str(min(int(expires_in), MAX_S3_EXPIRES)),
+        'X-Amz-SignedHeaders': signed_headers
+    })
+    if token:
+        params['X-Amz-Security-Token'] = token
+    query = '&'.join(
+        '{0}={1}'.format(_quote(k), _quote(v))
+        for k, v in sorted(params.items())
+    )
+
+    uri = '/{0}/{1}'.format(_quote(bucket), _quote(path, safe='/~'))
+    canonical_request = '\n'.join([
+        method,
+        uri,
+        query,
+        ''.join(
+            '{0}:{1}\n'.format(k, headers[k].strip())
+            for k in sorted(headers)
+        ),
+        signed_headers,
+        'UNSIGNED-PAYLOAD'
+    ])
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request).hexdigest()
+    ])
+
+    signature = _s3_signing_key(secret, date, region)
+    signature.update(string_to_sign)
+    return 'https://{0}{1}?{2}&X-Amz-Signature={3}'.format(
+        host, uri, query, signature.hexdigest()
+    )
+
+
+def sign_azure_blob(account, secret, container, blob, expires_in,
+                    now=None):
+    """
+    Return a URL to the blob `blob` carrying a read-only service SAS.
+
+    :param account: The storage account name.
+    :param secret: The storage account key, base64 encoded.
+    :param expires_in: How many seconds the URL is valid for.
+    :param now: Optionally the unix time to sign at, defaults to now.
+    """
+    expiry = time.strftime(
+        '%Y-%m-%dT%H:%M:%SZ',
+        time.gmtime((time.time() if now is None else now) + expires_in)
+    )
+    if isinstance(blob, unicode):
+        blob = blob.encode('utf-8')
+    # Permissions, start, expiry, resource, identifier, IP, protocol,
+    # version, resource type, snapshot time and the five response header
+    # overrides.
+    string_to_sign = '\n'.join([
+        'r',
+        '',
+        expiry,
+        '/blob/{0}/{1}/{2}'.format(account, container, blob),
+        '',
+        '',
+        '',
+        AZURE_SAS_VERSION,
+        'b',
+        '',
+        '',
+        '',
+        '',
+        '',
+        ''
+    ])
+
+    signature = _azure_signing_key(secret)
+    signature.update(string_to_sign)
+    return 'https://{0}.blob.core.windows.net/{1}/{2}?{3}'.format(
+        account,
+        container,
+        _quote(blob, safe='/~'),
+        '&'.join([
+            'sv=' + AZURE_SAS_VERSION,
+            'se=' + _quote(expiry, safe=''),
+            'sr=b',
+            'sp=r',
+            'sig=' + _quote(base64.b64encode(signature.digest()), safe='')
+        ])
+    )
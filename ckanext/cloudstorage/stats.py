@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import ckan.plugins as p
+
+log = logging.getLogger(__name__)
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. Anything
+# slower is counted in a final overflow bucket.
+BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_lock = threading.Lock()
+_operations = {}
+_sinks = []
+
+
+class _StatsdSink(object):
+    def __init__(self, host, port, prefix):
+        """
+        Send every recorded call to a StatsD server over UDP.
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, operation, elapsed, nbytes, error):
+        name = '{0}.{1}'.format(self.prefix, operation)
+        lines = [
+            '{0}:{1:.3f}|ms'.format(name, elapsed * 1000),
+            '{0}.count:1|c'.format(name)
+        ]
+        if nbytes:
+            lines.append('{0}.bytes:{1}|c'.format(name, nbytes))
+        if error:
+            lines.append('{0}.errors:1|c'.format(name))
+        try:
+            self.socket.sendto('\n'.join(lines).encode('utf-8'), self.address)
+        except socket.error:
+            # Metrics must never break a request.
+            pass
+
+
+def _log_sink(operation, elapsed, nbytes, error):
+    log.info(
+        '%s took %.1fms (%s bytes%s)',
+        operation, elapsed * 1000, nbytes, ', failed' if error else ''
+    )
+
+
+def configure(config):
+    """
+    Set up the optional StatsD and log sinks from `config`.
+
+    :param config: The CKAN configuration mapping.
+    """
+    del _sinks[:]
+
+    statsd = config.get('ckanext.cloudstorage.stats_statsd_host')
+    if statsd:
+        host, _, port = statsd.partition(':')
+        _sinks.append(_StatsdSink(
+            host,
+            int(port or 8125),
+            config.get(
+                'ckanext.cloudstorage.stats_statsd_prefix',
+                'ckanext.cloudstorage'
+            )
+        ))
+
+    if p.toolkit.asbool(config.get('ckanext.cloudstorage.stats_log', False)):
+        _sinks.append(_log_sink)
+
+
+def record(operation, elapsed, nbytes=0, error=False):
+    """
+    Record one provider call.
+
+    :param operation: The name of the call, ex: `get_object`.
+    :param elapsed: How long the call took, in seconds.
+    :param nbytes: The number of bytes sent or received.
+    :param error: `True` if the call failed.
+    """
+    ms = elapsed * 1000
+    bucket = len(BUCKETS)
+    for i, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            bucket = i
+            break
+
+    with _lock:
+        stats = _operations.get(operation)
+        if stats is None:
+            stats = _operations[operation] = {
+                'count': 0,
+                'errors': 0,
+                'bytes': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'histogram': [0] * (len(BUCKETS) + 1)
+            }
+        stats['count'] += 1
+        stats['errors'] += 1 if error else 0
+        stats['bytes'] += nbytes or 0
+        stats['total_ms'] += ms
+        stats['max_ms'] = max(stats['max_ms'], ms)
+        stats['histogram'][bucket] += 1
+
+    for sink in _sinks:
+        sink(operation, elapsed, nbytes, error)
+
+
+@contextmanager
+def timed(operation, nbytes=0, expected=()):
+    """
+    Time the body of a `with` block as one call to `operation`. The yielded
+    dict's `bytes` key can be set inside the block once the size is known.
+
+    :param expected: Exception types that are a normal answer from the
+                     provider, ex: a missing object, and not counted as
+                     errors.
+    """
+    metric = {'bytes': nbytes}
+    start = time.time()
+    try:
+        yield metric
+    except Exception as e:
+        record(
+            operation,
+            time.time() - start,
+            metric['bytes'],
+            error=not isinstance(e, expected)
+        )
+        raise
+    record(operation, time.time() - start, metric['bytes'])
+
+
+def instrument_connection(connection):
+    """
+    Record every request made through a libcloud connection as
+    `request.<METHOD>`.
+    """
+    request = connection.request
+
+    def timed_request(action, params=None, data=None, headers=None,
+                      method='GET', raw=False):
+        operation = 'request.' + method.upper()
+        nbytes = len(data) if hasattr(data, '__len__') else 0
+        start = time.time()
+        try:
+            resp = request(action, params=params, data=data,
+                           headers=headers, method=method, raw=raw)
+        except Exception:
+            record(operation, time.time() - start, nbytes, error=True)
+            raise
+        # Raw responses are only sent here, their status isn't known yet.
+        record(
+            operation,
+            time.time() - start,
+            nbytes,
+            error=not raw and not resp.success()
+        )
+        return resp
+
+    connection.request = timed_request
+
+
+def snapshot():
+    """
+    Return a copy of the statistics recorded so far, keyed by operation,
+    with the histogram bucket bounds.
+    """
+    with _lock:
+        operations = dict(
+            (name, dict(stats, histogram=list(stats['histogram'])))
+            for name, stats in _operations.items()
+        )
+    return {
+        'buckets_ms': list(BUCKETS),
+        'operations': operations
+    }
+
+
+def reset():
+    with _lock:
+        _operations.clear()
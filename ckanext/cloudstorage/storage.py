@@ -1,24 +1,94 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import base64
 import cgi
+import gzip
+import hashlib
+import httplib
+import logging
 import mimetypes
+import os
 import os.path
+import socket
+import tempfile
+import threading
+import time
+import urllib
 import urlparse
 from ast import literal_eval
-from datetime import datetime, timedelta
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 from tempfile import SpooledTemporaryFile
+from xml.etree.ElementTree import Element, SubElement, tostring
 
 from pylons import config
 from ckan import model
 from ckan.lib import munge
 import ckan.plugins as p
 
+from libcloud.common.types import LibcloudError
+from libcloud.storage.base import Object
 from libcloud.storage.types import Provider, ObjectDoesNotExistError
 from libcloud.storage.providers import get_driver
+from libcloud.utils.files import read_in_chunks
 
 
 from werkzeug.datastructures import FileStorage as FlaskFileStorage
+
+from ckanext.cloudstorage import cdn, signing, stats
+from ckanext.cloudstorage.cache import TTLCache
+from ckanext.cloudstorage.model import CloudStorageObject
+
 ALLOWED_UPLOAD_TYPES = (cgi.FieldStorage, FlaskFileStorage)
+# The most keys S3 accepts in a single DeleteObjects request.
+MAX_BATCH_DELETE = 1000
+# The smallest part S3 accepts in a multipart upload, except for the last.
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Compressed uploads are kept in memory up to this size, then on disk.
+GZIP_SPOOL_SIZE = 16 * 1024 * 1024
+# How much of an upload is read at once while compressing or hashing it.
+READ_BUFFER_SIZE = 1024 * 1024
+# The longest, in seconds, to wait for the parts of a multipart upload.
+UPLOAD_WAIT_TIMEOUT = 24 * 60 * 60
+# The most unread response body a kept-alive connection drains to reuse
+# its socket. Longer bodies are dropped with the socket instead.
+KEEP_ALIVE_DRAIN_SIZE = 64 * 1024
+# Requests that are safe to send again when a reused socket turns out to
+# have been closed by the server.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+log = logging.getLogger(__name__)
+
+# Settings parsed once by `configure`, shared by every CloudStorage
+# instance in the process.
+_settings = {}
+# Drivers and containers are not safe to share between threads (libcloud
+# keeps per-request state on the connection), so each thread gets its own.
+_pool = threading.local()
+# Signed download URLs, keyed by (resource_id, filename, content_type).
+secure_url_cache = TTLCache(0, 0)
+# Object keys this process deleted, so public URLs can be built without
+# asking the provider and still 404 for files we know are gone. Failed
+# lookups aren't remembered: another process may upload the file any time.
+missing_object_cache = TTLCache(0, 0)
+# Successful download auth checks, keyed by `download_auth_key`.
+download_auth_cache = TTLCache(0, 0)
+
+
+def download_auth_key(context, resource_id, metadata_modified,
+                      last_modified):
+    """
+    Return the `download_auth_cache` key of a `resource_show` auth check.
+
+    Anonymous users share a single entry per resource: their
+    `context['user']` is their IP address.
+    """
+    return (
+        context['user'] if context.get('auth_user_obj') else '',
+        resource_id,
+        metadata_modified,
+        last_modified
+    )
 
 
 def _get_underlying_file(wrapper):
@@ -27,15 +97,403 @@ def _get_underlying_file(wrapper):
     return wrapper.file
 
 
-class CloudStorage(object):
-    def __init__(self):
-        self.driver = get_driver(
+def _stream_size(stream):
+    """
+    Return the size of a seekable stream, rewinding it to the start, or -1
+    if the stream can't seek.
+    """
+    try:
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+    except (AttributeError, IOError):
+        return -1
+    return size
+
+
+def _gzip(fileobj):
+    """
+    Compress `fileobj` from its start in a single pass, returning a new
+    seekable file holding the gzipped data and its size.
+    """
+    out = SpooledTemporaryFile(max_size=GZIP_SPOOL_SIZE)
+    # A fixed mtime keeps the output identical for identical input.
+    gz = gzip.GzipFile(
+        filename='', mode='wb', compresslevel=6, fileobj=out, mtime=0
+    )
+    try:
+        fileobj.seek(0)
+        for buf in iter(lambda: fileobj.read(READ_BUFFER_SIZE), b''):
+            gz.write(buf)
+    finally:
+        gz.close()
+    size = out.tell()
+    out.seek(0)
+    return out, size
+
+
+def _sha256(fileobj):
+    """
+    Return the SHA-256 hex digest of `fileobj` from its start, rewinding it
+    afterwards.
+    """
+    sha256 = hashlib.sha256()
+    fileobj.seek(0)
+    for buf in iter(lambda: fileobj.read(READ_BUFFER_SIZE), b''):
+        sha256.update(buf)
+    fileobj.seek(0)
+    return sha256.hexdigest()
+
+
+def configure(config):
+    """
+    Parse the ckanext-cloudstorage options from `config` and discard any
+    pooled drivers built from a previous configuration.
+
+    :param config: The CKAN configuration mapping.
+    """
+    asbool = p.toolkit.asbool
+    generation = _settings.get('generation', 0) + 1
+
+    _settings.clear()
+    _settings.update({
+        'generation': generation,
+        'driver_name': config['ckanext.cloudstorage.driver'],
+        'driver_options': literal_eval(
+            config['ckanext.cloudstorage.driver_options']
+        ),
+        'container_name': config['ckanext.cloudstorage.container_name'],
+        'use_secure_urls': asbool(
+            config.get('ckanext.cloudstorage.use_secure_urls', False)
+        ),
+        'leave_files': asbool(
+            config.get('ckanext.cloudstorage.leave_files', False)
+        ),
+        'guess_mimetype': asbool(
+            config.get('ckanext.cloudstorage.guess_mimetype', False)
+        ),
+        'keep_alive': asbool(
+            config.get('ckanext.cloudstorage.keep_alive', False)
+        ),
+        'secure_url_lifetime': int(
+            config.get('ckanext.cloudstorage.secure_url_lifetime', 60 * 60)
+        ),
+        'check_object_exists': asbool(
+            config.get('ckanext.cloudstorage.check_object_exists', True)
+        ),
+        'direct_multipart_upload': asbool(
+            config.get('ckanext.cloudstorage.direct_multipart_upload', False)
+        ),
+        'use_manifest': asbool(
+            config.get('ckanext.cloudstorage.use_manifest', False)
+        ),
+        'multipart_threshold': int(
+            config.get(
+                'ckanext.cloudstorage.multipart_threshold', 100 * 1024 * 1024
+            )
+        ),
+        'multipart_part_size': max(MIN_PART_SIZE, int(
+            config.get(
+                'ckanext.cloudstorage.multipart_part_size', 16 * 1024 * 1024
+            )
+        )),
+        'upload_workers': int(
+            config.get('ckanext.cloudstorage.upload_workers', 4)
+        ),
+        'upload_retries': int(
+            config.get('ckanext.cloudstorage.upload_retries', 3)
+        ),
+        'delete_workers': int(
+            config.get('ckanext.cloudstorage.delete_workers', 8)
+        ),
+        'stream_downloads': asbool(
+            config.get('ckanext.cloudstorage.stream_downloads', False)
+        ),
+        'download_chunk_size': int(
+            config.get('ckanext.cloudstorage.download_chunk_size', 64 * 1024)
+        ),
+        'background_upload': asbool(
+            config.get('ckanext.cloudstorage.background_upload', False)
+        ),
+        'background_upload_dir': config.get(
+            'ckanext.cloudstorage.background_upload_dir',
+            os.path.join(tempfile.gettempdir(), 'ckanext-cloudstorage')
+        ),
+        'background_upload_queue': config.get(
+            'ckanext.cloudstorage.background_upload_queue', 'jobs'
+        ),
+        'background_upload_workers': int(
+            config.get('ckanext.cloudstorage.background_upload_workers', 2)
+        ),
+        'compress_uploads': asbool(
+            config.get('ckanext.cloudstorage.compress_uploads', False)
+        ),
+        'compress_mimetypes': set(config.get(
+            'ckanext.cloudstorage.compress_mimetypes',
+            'text/csv text/plain text/tab-separated-values text/xml'
+            ' application/json application/xml'
+        ).split()),
+        'compress_min_size': int(
+            config.get('ckanext.cloudstorage.compress_min_size', 64 * 1024)
+        ),
+        'cache_control': literal_eval(
+            config.get('ckanext.cloudstorage.cache_control', '{}')
+        ),
+        'private_cache_control': literal_eval(
+            config.get('ckanext.cloudstorage.private_cache_control', '{}')
+        ),
+        'deduplicate_uploads': asbool(
+            config.get('ckanext.cloudstorage.deduplicate_uploads', False)
+        ),
+        'fast_download_lookup': asbool(
+            config.get('ckanext.cloudstorage.fast_download_lookup', True)
+        ),
+        'public_url_max_age': int(
+            config.get(
+                'ckanext.cloudstorage.public_url_max_age', 24 * 60 * 60
+            )
+        ),
+        'cdn_url': config.get('ckanext.cloudstorage.cdn_url'),
+        'cdn_path_map': literal_eval(
+            config.get('ckanext.cloudstorage.cdn_path_map', '{}')
+        ),
+        'cdn_signing': config.get('ckanext.cloudstorage.cdn_signing'),
+        'cdn_signing_key': config.get('ckanext.cloudstorage.cdn_signing_key'),
+        'cdn_token_name': config.get(
+            'ckanext.cloudstorage.cdn_token_name', '__token__'
+        ),
+        'cdn_key_pair_id': config.get('ckanext.cloudstorage.cdn_key_pair_id'),
+        'region': config.get('ckanext.cloudstorage.region'),
+    })
+
+    # The RSA key is parsed once, not every time a URL is signed.
+    if _settings['cdn_signing'] == 'cloudfront':
+        _settings['cdn_private_key'] = cdn.load_private_key(
+            config['ckanext.cloudstorage.cdn_private_key']
+        )
+
+    # Only hand out cached URLs that still have a good part of their
+    # lifetime left, so clients never get one that is about to expire.
+    lifetime = _settings['secure_url_lifetime']
+    secure_url_cache.clear()
+    secure_url_cache.maxsize = int(
+        config.get('ckanext.cloudstorage.secure_url_cache_size', 1000)
+    )
+    secure_url_cache.ttl = min(lifetime, int(
+        config.get('ckanext.cloudstorage.secure_url_cache_ttl', lifetime // 2)
+    ))
+
+    missing_object_cache.clear()
+    missing_object_cache.maxsize = int(
+        config.get('ckanext.cloudstorage.missing_object_cache_size', 1000)
+    )
+    missing_object_cache.ttl = int(
+        config.get('ckanext.cloudstorage.missing_object_cache_ttl', 5 * 60)
+    )
+
+    download_auth_cache.clear()
+    download_auth_cache.maxsize = int(
+        config.get('ckanext.cloudstorage.download_auth_cache_size', 1000)
+    )
+    download_auth_cache.ttl = int(
+        config.get('ckanext.cloudstorage.download_auth_cache_ttl', 60)
+    )
+
+    stats.configure(config)
+
+
+def _setting(key):
+    if not _settings:
+        configure(config)
+    return _settings[key]
+
+
+def _enable_keep_alive(connection):
+    """
+    Make a libcloud connection reuse its underlying HTTP(S) connection
+    between requests instead of opening a new one every time.
+
+    A socket is only reused once the previous response has been read to the
+    end, or can be by draining a short remaining body. Raw requests, whose
+    bodies are sent after `request` returns, always get a fresh socket. An
+    idempotent request that fails on a reused socket, which the server may
+    have closed while it sat idle, is retried once on a new one.
+    """
+    connect = connection.connect
+    request = connection.request
+    # The HTTP connection we opened, the last response read from it, whether
+    # a request was sent without reading its response, whether the next
+    # request must reconnect and whether the current one reused the socket.
+    state = {
+        'http': None,
+        'response': None,
+        'sent': False,
+        'fresh': False,
+        'reused': False
+    }
+
+    def track(http):
+        putrequest = http.putrequest
+        getresponse = http.getresponse
+
+        def tracked_putrequest(*args, **kwargs):
+            state['sent'] = True
+            return putrequest(*args, **kwargs)
+
+        def tracked_getresponse(*args, **kwargs):
+            state['sent'] = False
+            state['response'] = getresponse(*args, **kwargs)
+            return state['response']
+
+        http.putrequest = tracked_putrequest
+        http.getresponse = tracked_getresponse
+        state.update(http=http, response=None, sent=False)
+
+    def reusable():
+        if state['fresh'] or state['sent']:
+            return False
+        response = state['response']
+        if response is None or response.isclosed():
+            return True
+        if response.length is not None and (
+                response.length <= KEEP_ALIVE_DRAIN_SIZE):
+            try:
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                return False
+            return response.isclosed()
+        return False
+
+    def keep_alive_connect(host=None, port=None, base_url=None, **kwargs):
+        http = connection.connection
+        state['reused'] = False
+        if (http is not None and http is state['http'] and
+                not (host or port or base_url or kwargs) and reusable()):
+            state['reused'] = True
+            return
+        if http is not None:
+            http.close()
+        connect(host=host, port=port, base_url=base_url, **kwargs)
+        track(connection.connection)
+
+    def keep_alive_request(action, params=None, data=None, headers=None,
+                           method='GET', raw=False):
+        state['fresh'] = raw
+        try:
+            return request(action, params=params, data=data,
+                           headers=headers, method=method, raw=raw)
+        except (httplib.HTTPException, socket.error):
+            reused = state['reused']
+            # Whatever state the socket is in, don't use it again.
+            state['http'] = None
+            if not reused or method.upper() not in IDEMPOTENT_METHODS:
+                raise
+            log.debug('Reconnecting after a reused connection failed')
+            return request(action, params=params, data=data,
+                           headers=headers, method=method, raw=raw)
+
+    connection.connect = keep_alive_connect
+    connection.request = keep_alive_request
+
+
+def _thread_pool():
+    """
+    Return the driver pool for the current thread, resetting it if the
+    configuration changed or the process forked since it was filled.
+    """
+    generation = _setting('generation')
+    pid = os.getpid()
+    if getattr(_pool, 'key', None) != (generation, pid):
+        _pool.key = (generation, pid)
+        _pool.driver = None
+        _pool.container = None
+    return _pool
+
+
+def pooled_driver():
+    """
+    Return the libcloud driver for the current thread, creating it on
+    first use.
+    """
+    pool = _thread_pool()
+    if pool.driver is None:
+        driver = get_driver(
             getattr(
                 Provider,
-                self.driver_name
+                _setting('driver_name')
+            )
+        )(**_setting('driver_options'))
+        if _setting('keep_alive'):
+            _enable_keep_alive(driver.connection)
+        stats.instrument_connection(driver.connection)
+        pool.driver = driver
+    return pool.driver
+
+
+def pooled_container():
+    """
+    Return the configured libcloud container for the current thread,
+    fetching it from the provider on first use.
+    """
+    pool = _thread_pool()
+    if pool.container is None:
+        with stats.timed('get_container'):
+            pool.container = pooled_driver().get_container(
+                container_name=_setting('container_name')
             )
-        )(**self.driver_options)
-        self._container = None
+    return pool.container
+
+
+def _delete_object(obj):
+    # Runs in a worker thread, so it must use that thread's own driver.
+    try:
+        with stats.timed('delete_object', expected=ObjectDoesNotExistError):
+            pooled_driver().delete_object(obj)
+    except ObjectDoesNotExistError:
+        pass
+    except Exception:
+        log.exception('Unable to delete cloud object %s', obj.name)
+        return False
+    return True
+
+
+class _FileSlice(object):
+    """
+    A read-only view of `size` bytes of `fileobj` starting at `start`, so
+    several threads can read different parts of one file. Reads are
+    serialised by `lock`, which must be shared by every slice of the file.
+    """
+    def __init__(self, fileobj, lock, start, size):
+        self._fileobj = fileobj
+        self._lock = lock
+        self._start = start
+        self._size = size
+        self._position = 0
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            offset += self._size
+        elif whence == os.SEEK_CUR:
+            offset += self._position
+        self._position = max(0, min(offset, self._size))
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        remaining = self._size - self._position
+        if size < 0 or size > remaining:
+            size = remaining
+        with self._lock:
+            self._fileobj.seek(self._start + self._position)
+            data = self._fileobj.read(size)
+        self._position += len(data)
+        return data
+
+
+class CloudStorage(object):
+    def __init__(self):
+        self.driver = pooled_driver()
 
     def path_from_filename(self, rid, filename):
         raise NotImplemented
@@ -45,12 +503,324 @@ class CloudStorage(object):
         """
         Return the currently configured libcloud container.
         """
-        if self._container is None:
-            self._container = self.driver.get_container(
-                container_name=self.container_name
+        return pooled_container()
+
+    def iterate_prefix(self, prefix):
+        """
+        Yield every object in the container whose key starts with `prefix`.
+
+        The listing is done by the provider where the driver supports it,
+        otherwise the whole container is listed and filtered.
+
+        :param prefix: The key prefix, ex: `resources/<id>/`.
+        """
+        try:
+            objects = self.driver.iterate_container_objects(
+                self.container,
+                ex_prefix=prefix
+            )
+        except TypeError:
+            # This driver doesn't support prefix listing.
+            objects = self.container.iterate_objects()
+
+        for obj in objects:
+            if obj.name.startswith(prefix):
+                yield obj
+
+    def delete_objects(self, objects):
+        """
+        Delete every object in `objects`, using batched DeleteObjects
+        requests on S3 and concurrent single deletes everywhere else.
+
+        :param objects: An iterable of libcloud Objects.
+        :returns: The number of objects deleted.
+        """
+        objects = iter(objects)
+        deleted = 0
+
+        if 'S3' in self.driver_name:
+            while True:
+                batch = list(islice(objects, MAX_BATCH_DELETE))
+                if not batch:
+                    break
+                deleted += self._batch_delete(batch)
+            return deleted
+
+        pool = ThreadPool(self.delete_workers)
+        try:
+            while True:
+                batch = list(islice(objects, MAX_BATCH_DELETE))
+                if not batch:
+                    break
+                for obj in batch:
+                    missing_object_cache.set(obj.name, True)
+                deleted += sum(pool.map(_delete_object, batch))
+                self._forget(batch)
+        finally:
+            pool.close()
+            pool.join()
+        return deleted
+
+    def _batch_delete(self, objects):
+        """
+        Delete up to `MAX_BATCH_DELETE` objects in a single S3
+        DeleteObjects request.
+        """
+        root = Element('Delete')
+        SubElement(root, 'Quiet').text = 'true'
+        for obj in objects:
+            missing_object_cache.set(obj.name, True)
+            SubElement(SubElement(root, 'Object'), 'Key').text = obj.name
+
+        data = tostring(root)
+        with stats.timed('batch_delete'):
+            resp = self.driver.connection.request(
+                '/' + self.container_name + '?delete',
+                method='POST',
+                data=data,
+                headers={
+                    'Content-MD5': base64.b64encode(
+                        hashlib.md5(data).digest()
+                    ),
+                    'Content-Type': 'application/xml'
+                }
+            )
+        if not resp.success():
+            raise RuntimeError(
+                'Batch delete failed: {0}'.format(resp.error)
+            )
+
+        # In quiet mode only the keys that failed are returned.
+        errors = [
+            e for e in getattr(resp.object, 'getchildren', list)()
+            if e.tag.endswith('Error')
+        ]
+        for error in errors:
+            log.error('Unable to delete cloud object: %s', tostring(error))
+        self._forget(objects)
+        return len(objects) - len(errors)
+
+    def _forget(self, objects):
+        if self.use_manifest:
+            CloudStorageObject.forget(obj.name for obj in objects)
+
+    def make_object(self, name, size=None, hash=None, extra=None):
+        """
+        Build a libcloud Object for `name` in the configured container
+        without a request to the provider.
+        """
+        return Object(
+            name=name,
+            size=size,
+            hash=hash,
+            extra=extra or {},
+            meta_data={},
+            container=self.container,
+            driver=self.driver
+        )
+
+    def put_object(self, path, fileobj, size, headers=None):
+        """
+        Upload `size` bytes of the seekable `fileobj` to `path` on S3 with
+        the given headers, which libcloud's S3 driver can't set. Files
+        larger than `multipart_threshold` are sent in parts.
+
+        :param path: The object's key in the container.
+        :param fileobj: A seekable file-like object.
+        :param size: The number of bytes to upload.
+        :param headers: Optional headers stored with the object, such as
+                        Content-Type and Content-Encoding.
+        :returns: The ETag of the new object.
+        """
+        from ckanext.cloudstorage.logic.action import multipart
+
+        threshold = _setting('multipart_threshold')
+        if threshold and size > threshold:
+            return self.upload_in_parts(path, fileobj, size, headers=headers)
+
+        resp = multipart._stream_part(
+            self,
+            multipart._get_object_url(self, path),
+            fileobj,
+            headers=headers,
+            operation='put_object'
+        )
+        if resp.status != 200:
+            raise LibcloudError(
+                'Upload failed with status {0}'.format(resp.status),
+                driver=self.driver
+            )
+        return resp.headers['etag']
+
+    def copy_object(self, source, destination, headers=None):
+        """
+        Copy the object at the key `source` to the key `destination` in the
+        container without downloading it.
+
+        :param headers: Optionally replace the copy's Content-Type,
+                        Cache-Control and Content-Encoding with these.
+        :returns: The ETag of the copy, or None if the provider doesn't
+                  return one.
+        :raises NotImplementedError: If the driver can't copy objects.
+        """
+        headers = headers or {}
+        if self.can_use_advanced_azure:
+            from azure.storage import blob as azure_blob
+            from azure.storage.blob.models import ContentSettings
+
+            blob_service = azure_blob.BlockBlobService(
+                self.driver_options['key'],
+                self.driver_options['secret']
             )
+            with stats.timed('copy_object'):
+                blob_service.copy_blob(
+                    self.container_name,
+                    destination,
+                    blob_service.make_blob_url(self.container_name, source)
+                )
+                if headers:
+                    blob_service.set_blob_properties(
+                        self.container_name,
+                        destination,
+                        content_settings=ContentSettings(
+                            content_type=headers.get('Content-Type'),
+                            content_encoding=headers.get('Content-Encoding'),
+                            cache_control=headers.get('Cache-Control')
+                        )
+                    )
+            return
+
+        if not getattr(self.driver, 'supports_s3_multipart_upload', False):
+            raise NotImplementedError
 
-        return self._container
+        from ckanext.cloudstorage.logic.action import multipart
+
+        prefix = self.driver.http_vendor_prefix
+        headers = dict(headers)
+        headers[prefix + '-copy-source'] = urllib.quote(
+            multipart._get_object_url(self, source)
+        )
+        if len(headers) > 1:
+            headers[prefix + '-metadata-directive'] = 'REPLACE'
+        with stats.timed('copy_object', expected=ObjectDoesNotExistError):
+            resp = self.driver.connection.request(
+                multipart._get_object_url(self, destination),
+                method='PUT',
+                headers=headers
+            )
+            if resp.status == 404:
+                raise ObjectDoesNotExistError(
+                    value='', driver=self.driver, object_name=source
+                )
+            # A copy can fail after S3 has already answered 200, in which
+            # case the body is an Error document.
+            if not resp.success() or resp.object.tag.endswith('Error'):
+                raise LibcloudError(
+                    'Copy failed: {0}'.format(resp.body),
+                    driver=self.driver
+                )
+        for element in resp.object:
+            if element.tag.endswith('ETag'):
+                return element.text.strip('"')
+
+    def should_compress(self, content_type, size):
+        """
+        `True` if an upload of `size` bytes of `content_type` should be
+        stored gzipped, otherwise `False`.
+        """
+        return (
+            _setting('compress_uploads') and
+            content_type in _setting('compress_mimetypes') and
+            size >= _setting('compress_min_size')
+        )
+
+    def upload_in_parts(self, path, fileobj, size, headers=None):
+        """
+        Upload `size` bytes of the seekable `fileobj` to `path` as an S3
+        multipart upload, sending parts concurrently and retrying each part
+        on its own.
+
+        :param path: The object's key in the container.
+        :param fileobj: A seekable file-like object.
+        :param size: The number of bytes to upload.
+        :param headers: Optional headers for the initiate request, such as
+                        Content-Type.
+        :returns: The ETag of the finished object.
+        """
+        from ckanext.cloudstorage.logic.action import multipart
+
+        part_size = self.multipart_part_size
+        upload_id = multipart._initiate_upload(self, path, headers=headers)
+        lock = threading.Lock()
+        stopped = threading.Event()
+
+        def upload_part(part_number):
+            # Runs in a worker thread, so it must use that thread's own
+            # driver.
+            uploader = CloudStorage()
+            start = (part_number - 1) * part_size
+            part = _FileSlice(
+                fileobj, lock, start, min(part_size, size - start)
+            )
+            attempt = 0
+            while True:
+                attempt += 1
+                if stopped.is_set():
+                    raise RuntimeError(
+                        'Upload of part {0} cancelled'.format(part_number)
+                    )
+                try:
+                    resp = multipart._stream_part(
+                        uploader,
+                        multipart._get_part_url(
+                            uploader, path, upload_id, part_number
+                        ),
+                        part
+                    )
+                    if resp.status == 200:
+                        return part_number, resp.headers['etag']
+                    error = 'status {0}'.format(resp.status)
+                except Exception as e:
+                    error = e
+                if attempt > self.upload_retries:
+                    raise RuntimeError(
+                        'Upload of part {0} failed: {1}'.format(
+                            part_number, error
+                        )
+                    )
+                log.warning(
+                    'Retrying part %s of %s after error: %s',
+                    part_number, path, error
+                )
+                stopped.wait(2 ** attempt)
+
+        parts = max(1, -(-size // part_size))
+        pool = ThreadPool(_setting('upload_workers'))
+        try:
+            # Waiting with a timeout keeps KeyboardInterrupt deliverable.
+            chunks = pool.map_async(upload_part, range(1, parts + 1)).get(
+                UPLOAD_WAIT_TIMEOUT
+            )
+            pool.close()
+            pool.join()
+            with stats.timed('commit_multipart'):
+                return self.driver._commit_multipart(
+                    multipart._get_object_url(self, path),
+                    upload_id,
+                    chunks
+                )
+        except BaseException:
+            # Let parts still in flight finish and drop the queued ones
+            # first, so no part lands after the upload is aborted.
+            stopped.set()
+            pool.terminate()
+            pool.join()
+            with stats.timed('abort_multipart'):
+                self.driver._abort_multipart(
+                    multipart._get_object_url(self, path),
+                    upload_id
+                )
+            raise
 
     @property
     def driver_options(self):
@@ -58,7 +828,7 @@ class CloudStorage(object):
         A dictionary of options ckanext-cloudstorage has been configured to
         pass to the apache-libcloud driver.
         """
-        return literal_eval(config['ckanext.cloudstorage.driver_options'])
+        return _setting('driver_options')
 
     @property
     def driver_name(self):
@@ -72,7 +842,7 @@ class CloudStorage(object):
             This value is used to lookup the apache-libcloud driver to use
             based on the Provider enum.
         """
-        return config['ckanext.cloudstorage.driver']
+        return _setting('driver_name')
 
     @property
     def container_name(self):
@@ -80,7 +850,7 @@ class CloudStorage(object):
         The name of the container (also called buckets on some providers)
         ckanext-cloudstorage is configured to use.
         """
-        return config['ckanext.cloudstorage.container_name']
+        return _setting('container_name')
 
     @property
     def use_secure_urls(self):
@@ -88,9 +858,7 @@ class CloudStorage(object):
         `True` if ckanext-cloudstroage is configured to generate secure
         one-time URLs to resources, `False` otherwise.
         """
-        return p.toolkit.asbool(
-            config.get('ckanext.cloudstorage.use_secure_urls', False)
-        )
+        return _setting('use_secure_urls')
 
     @property
     def leave_files(self):
@@ -99,9 +867,143 @@ class CloudStorage(object):
         provider instead of removing them when a resource/package is deleted,
         otherwise `False`.
         """
-        return p.toolkit.asbool(
-            config.get('ckanext.cloudstorage.leave_files', False)
-        )
+        return _setting('leave_files')
+
+    @property
+    def secure_url_lifetime(self):
+        """
+        The number of seconds a secure URL remains valid for.
+        """
+        return _setting('secure_url_lifetime')
+
+    @property
+    def deduplicate_uploads(self):
+        """
+        `True` if uploads whose contents are already in the container are
+        copied there instead of being sent again, otherwise `False`. Needs
+        the manifest.
+        """
+        return self.use_manifest and _setting('deduplicate_uploads')
+
+    @property
+    def fast_download_lookup(self):
+        """
+        `True` if downloads look up the resource row directly instead of
+        calling `resource_show`, otherwise `False`.
+        """
+        return _setting('fast_download_lookup')
+
+    @property
+    def public_url_max_age(self):
+        """
+        The number of seconds clients and proxies may cache a redirect to a
+        public (unsigned) URL for.
+        """
+        return _setting('public_url_max_age')
+
+    @property
+    def cdn_url(self):
+        """
+        The base URL of a CDN in front of the container, which download URLs
+        are built on instead of the provider's host, or None.
+        """
+        return _setting('cdn_url')
+
+    @property
+    def cdn_signing(self):
+        """
+        How CDN URLs to private resources are signed: `hmac`, `cloudfront`,
+        or None to not sign them.
+        """
+        if self.cdn_url:
+            return _setting('cdn_signing')
+
+    @property
+    def check_object_exists(self):
+        """
+        `True` if ckanext-cloudstorage should ask the provider whether an
+        object exists before returning a public URL to it, `False` if the
+        URL should be built locally.
+        """
+        return _setting('check_object_exists')
+
+    @property
+    def direct_multipart_upload(self):
+        """
+        `True` if browsers should upload multipart chunks straight to the
+        provider using presigned part URLs, `False` if chunks are proxied
+        through CKAN.
+        """
+        return _setting('direct_multipart_upload')
+
+    @property
+    def delete_workers(self):
+        """
+        The number of threads used to delete objects or abort uploads
+        concurrently.
+        """
+        return _setting('delete_workers')
+
+    @property
+    def stream_downloads(self):
+        """
+        `True` if downloads are streamed through CKAN instead of redirecting
+        the client to the provider, otherwise `False`.
+        """
+        return _setting('stream_downloads')
+
+    @property
+    def multipart_part_size(self):
+        """
+        The size, in bytes, of the parts large uploads are split into.
+        """
+        return _setting('multipart_part_size')
+
+    @property
+    def upload_retries(self):
+        """
+        The number of times a failed upload, or part of one, is retried.
+        """
+        return _setting('upload_retries')
+
+    @property
+    def background_upload(self):
+        """
+        `True` if uploaded files are spooled to local disk and sent to the
+        provider by a background worker, otherwise `False`.
+        """
+        return _setting('background_upload')
+
+    @property
+    def background_upload_dir(self):
+        """
+        The directory files waiting for a background upload are kept in.
+        """
+        return _setting('background_upload_dir')
+
+    @property
+    def background_upload_queue(self):
+        """
+        Where background uploads are queued: `jobs` for CKAN's background
+        jobs, or `local` for a queue served by threads in this process.
+        """
+        return _setting('background_upload_queue')
+
+    @property
+    def background_upload_workers(self):
+        """
+        The number of threads serving the `local` background upload queue.
+        """
+        return _setting('background_upload_workers')
+
+    @property
+    def use_manifest(self):
+        """
+        `True` if ckanext-cloudstorage keeps a local manifest of the
+        objects it has written and answers existence checks from it,
+        otherwise `False`.
+        """
+        return _setting('use_manifest')
 
     @property
     def can_use_advanced_azure(self):
@@ -142,15 +1044,40 @@ class CloudStorage(object):
 
         return False
 
+    @property
+    def can_sign_urls(self):
+        """
+        `True` if secure URLs can be signed for the configured driver (Azure
+        or Amazon S3), otherwise `False`.
+        """
+        return self.driver_name == 'AZURE_BLOBS' or 'S3' in self.driver_name
+
+    @property
+    def region(self):
+        """
+        The S3 region secure URLs are signed for, from the `region` option
+        or the driver.
+        """
+        region = _setting('region') or getattr(
+            self.driver, 'region_name', None
+        )
+        if region:
+            return region
+        location = getattr(self.driver, 'ex_location_name', '')
+        return {'': 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+
     @property
     def guess_mimetype(self):
         """
         `True` if ckanext-cloudstorage is configured to guess mime types,
         `False` otherwise.
+
+        .. note::
+
+            Content types are now always guessed on every driver, this
+            option is only kept so existing configurations still load.
         """
-        return p.toolkit.asbool(
-            config.get('ckanext.cloudstorage.guess_mimetype', False)
-        )
+        return _setting('guess_mimetype')
 
 
 class ResourceCloudStorage(CloudStorage):
@@ -210,6 +1137,15 @@ class ResourceCloudStorage(CloudStorage):
             munge.munge_filename(filename)
         )
 
+    @property
+    def resources_prefix(self):
+        """
+        The key prefix shared by every resource object, ex: `resources/`.
+        """
+        return os.path.dirname(
+            os.path.dirname(self.path_from_filename('fake-id', 'fake-name'))
+        ) + '/'
+
     def upload(self, id, max_size=10):
         """
         Complete the file upload, or clear an existing upload.
@@ -218,62 +1154,363 @@ class ResourceCloudStorage(CloudStorage):
         :param max_size: Ignored.
         """
         if self.filename:
-            if self.can_use_advanced_azure:
-                from azure.storage import blob as azure_blob
-                from azure.storage.blob.models import ContentSettings
+            missing_object_cache.pop(
+                self.path_from_filename(id, self.filename)
+            )
+
+            if self.background_upload:
+                from ckanext.cloudstorage import background
+                return background.enqueue(self, id)
+            return self.upload_file(id)
+
+        elif self._clear and self.old_filename and not self.leave_files:
+            # This is only set when a previously-uploaded file is replace
+            # by a link. We want to delete the previously-uploaded file.
+            path = self.path_from_filename(id, self.old_filename)
+            missing_object_cache.set(path, True)
+            if self.use_manifest:
+                CloudStorageObject.forget([path])
+            try:
+                with stats.timed('get_object',
+                                 expected=ObjectDoesNotExistError):
+                    obj = self.container.get_object(path)
+                with stats.timed('delete_object',
+                                 expected=ObjectDoesNotExistError):
+                    self.container.delete_object(obj)
+            except ObjectDoesNotExistError:
+                # It's possible for the object to have already been deleted, or
+                # for it to not yet exist in a committed state due to an
+                # outstanding lease.
+                return
+
+    def upload_file(self, id):
+        """
+        Send `file_upload` to the provider as the resource's file.
+
+        :param id: The resource_id.
+        """
+        metadata = self.object_metadata(self.filename)
+        content_type = metadata['content_type']
+        size = _stream_size(self.file_upload)
+        stream = self.file_upload
+        content_encoding = None
+        content_hash = None
+
+        if self.deduplicate_uploads and size >= 0:
+            content_hash = _sha256(stream)
+            if self._copy_duplicate(id, content_hash, metadata):
+                return
+
+        if self.can_use_advanced_azure:
+            from azure.storage import blob as azure_blob
+            from azure.storage.blob.models import ContentSettings
+
+            blob_service = azure_blob.BlockBlobService(
+                self.driver_options['key'],
+                self.driver_options['secret']
+            )
+            if self.should_compress(content_type, size):
+                stream, size = _gzip(stream)
+                content_encoding = 'gzip'
 
-                blob_service = azure_blob.BlockBlobService(
-                    self.driver_options['key'],
-                    self.driver_options['secret']
+            content_settings = None
+            if content_type or content_encoding or (
+                    metadata['cache_control']):
+                content_settings = ContentSettings(
+                    content_type=content_type,
+                    content_encoding=content_encoding,
+                    cache_control=metadata['cache_control']
                 )
-                content_settings = None
-                if self.guess_mimetype:
-                    content_type, _ = mimetypes.guess_type(self.filename)
-                    if content_type:
-                        content_settings = ContentSettings(
-                            content_type=content_type
-                        )
 
-                return blob_service.create_blob_from_stream(
+            with stats.timed('upload_object') as metric:
+                result = blob_service.create_blob_from_stream(
                     container_name=self.container_name,
                     blob_name=self.path_from_filename(
                         id,
                         self.filename
                     ),
-                    stream=self.file_upload,
+                    stream=stream,
                     content_settings=content_settings
                 )
-            else:
+                metric['bytes'] = stream.tell()
+            self._record(
+                id,
+                size=stream.tell(),
+                etag=result.etag,
+                content_encoding=content_encoding,
+                content_hash=content_hash
+            )
+            return result
+        else:
+            path = self.path_from_filename(id, self.filename)
+            threshold = _setting('multipart_threshold')
+            s3 = getattr(self.driver, 'supports_s3_multipart_upload', False)
+            if s3 and self.should_compress(content_type, size):
+                stream, size = _gzip(stream)
+                content_encoding = 'gzip'
+            headers = self.object_headers(metadata, content_encoding)
+
+            # libcloud's S3 driver can only set the Content-Type itself.
+            if s3 and size >= 0 and (
+                    content_encoding or
+                    metadata['cache_control'] or
+                    (threshold and size > threshold)):
+                with stats.timed('upload_object', size):
+                    etag = self.put_object(path, stream, size, headers)
+                self._record(
+                    id,
+                    size=size,
+                    etag=etag,
+                    content_encoding=content_encoding,
+                    content_hash=content_hash
+                )
+                return
 
-                # TODO: This might not be needed once libcloud is upgraded
-                if isinstance(self.file_upload, SpooledTemporaryFile):
-                    self.file_upload.next = self.file_upload.next()
+            # TODO: This might not be needed once libcloud is upgraded
+            if isinstance(self.file_upload, SpooledTemporaryFile):
+                self.file_upload.next = self.file_upload.next()
 
-                self.container.upload_object_via_stream(
+            with stats.timed('upload_object') as metric:
+                obj = self.container.upload_object_via_stream(
                     self.file_upload,
                     object_name=self.path_from_filename(
                         id,
                         self.filename
-                    )
+                    ),
+                    extra={'content_type': content_type} if content_type
+                    else None
                 )
+                metric['bytes'] = obj.size
+            self._record(
+                id,
+                size=obj.size,
+                etag=obj.hash,
+                content_hash=content_hash
+            )
 
-        elif self._clear and self.old_filename and not self.leave_files:
-            # This is only set when a previously-uploaded file is replace
-            # by a link. We want to delete the previously-uploaded file.
+    def object_metadata(self, filename):
+        """
+        Return the `content_type` and `cache_control` an object named
+        `filename` should be stored with for this resource, either of which
+        may be None.
+
+        The Cache-Control comes from the `cache_control` rules, or the
+        `private_cache_control` rules if the resource's dataset is private.
+        Rules map a mimetype, a `type/*` wildcard or `*` to a value.
+        """
+        content_type = mimetypes.guess_type(filename)[0]
+        rules = {}
+        if _setting('cache_control') or _setting('private_cache_control'):
+            rules = _setting(
+                'private_cache_control' if self._is_private()
+                else 'cache_control'
+            )
+        cache_control = None
+        if content_type:
+            cache_control = (
+                rules.get(content_type) or
+                rules.get(content_type.split('/')[0] + '/*')
+            )
+        return {
+            'content_type': content_type,
+            'cache_control': cache_control or rules.get('*')
+        }
+
+    def _is_private(self):
+        package_id = self.resource.get('package_id')
+        if not package_id:
+            return False
+        package = model.Package.get(package_id)
+        return bool(package and package.private)
+
+    def object_headers(self, metadata, content_encoding=None):
+        """
+        Return the HTTP headers an S3 object is written with for
+        `metadata` and `content_encoding`.
+        """
+        headers = {}
+        if metadata['content_type']:
+            headers['Content-Type'] = metadata['content_type']
+        if metadata['cache_control']:
+            headers['Cache-Control'] = metadata['cache_control']
+        if content_encoding:
+            headers['Content-Encoding'] = content_encoding
+            # libcloud doesn't expose Content-Encoding on S3 objects, so it
+            # is kept as user metadata for the streaming proxy too.
+            prefix = getattr(self.driver, 'http_vendor_prefix', 'x-amz')
+            headers[prefix + '-meta-content-encoding'] = content_encoding
+        return headers
+
+    def _copy_duplicate(self, id, content_hash, metadata):
+        """
+        Store the resource's file by copying an object already in the
+        container with the same contents, if the manifest knows of one.
+
+        :returns: `True` if the file is now stored, `False` if it still has
+                  to be uploaded.
+        """
+        path = self.path_from_filename(id, self.filename)
+        source = CloudStorageObject.find_by_hash(
+            content_hash, metadata['content_type'], prefer_key=path
+        )
+        if source is None:
+            return False
+
+        etag = source.etag
+        if source.key != path:
             try:
-                self.container.delete_object(
-                    self.container.get_object(
-                        self.path_from_filename(
-                            id,
-                            self.old_filename
-                        )
+                etag = self.copy_object(
+                    source.key,
+                    path,
+                    headers=self.object_headers(
+                        metadata, source.content_encoding
                     )
-                )
+                ) or etag
+            except NotImplementedError:
+                return False
             except ObjectDoesNotExistError:
-                # It's possible for the object to have already been deleted, or
-                # for it to not yet exist in a committed state due to an
-                # outstanding lease.
+                CloudStorageObject.forget([source.key])
+                return False
+            except Exception:
+                log.exception('Unable to copy %s to %s', source.key, path)
+                return False
+
+        self._record(
+            id,
+            size=source.size,
+            etag=etag,
+            content_encoding=source.content_encoding,
+            content_hash=content_hash
+        )
+        return True
+
+    def _record(self, id, size=None, etag=None, content_encoding=None,
+                content_hash=None):
+        if self.use_manifest:
+            CloudStorageObject.record(
+                self.path_from_filename(id, self.filename),
+                id,
+                size=size,
+                etag=etag,
+                content_type=mimetypes.guess_type(self.filename)[0],
+                content_encoding=content_encoding,
+                content_hash=content_hash
+            )
+
+    def iterate_resource_objects(self, rid):
+        """
+        Yield every object stored for the resource `rid`, from the manifest
+        if it is enabled, otherwise from the provider.
+        """
+        if self.use_manifest:
+            for row in CloudStorageObject.resource_objects(rid):
+                yield self.make_object(row.key, size=row.size, hash=row.etag)
+            return
+
+        prefix = os.path.dirname(self.path_from_filename(rid, 'fake-name'))
+        for obj in self.iterate_prefix(prefix + '/'):
+            yield obj
+
+    def get_object(self, rid, filename):
+        """
+        Return the libcloud Object stored for the given resource_id and
+        filename, or None if it doesn't exist. With the manifest enabled the
+        object is built from it without a request to the provider.
+
+        :param rid: The resource ID.
+        :param filename: The resource filename.
+        """
+        path = self.path_from_filename(rid, filename)
+        if missing_object_cache.get(path):
+            return
+
+        if self.use_manifest:
+            row = model.Session.query(CloudStorageObject).get(path)
+            if row is None:
                 return
+            return self.make_object(
+                path,
+                size=row.size,
+                hash=row.etag,
+                extra={
+                    'content_type': row.content_type,
+                    'content_encoding': row.content_encoding
+                }
+            )
+
+        try:
+            with stats.timed('get_object', expected=ObjectDoesNotExistError):
+                return self.container.get_object(path)
+        except ObjectDoesNotExistError:
+            return
+
+    def iterate_object(self, obj, start=0, end=None):
+        """
+        Yield the contents of `obj` in chunks of `download_chunk_size`
+        bytes, holding no more than one chunk in memory.
+
+        :param obj: The libcloud Object to download.
+        :param start: The offset of the first byte to return.
+        :param end: The offset of the last byte to return, or None to read
+                    to the end of the object.
+        """
+        chunk_size = _setting('download_chunk_size')
+        get_path = getattr(self.driver, '_get_object_path', None)
+        skip = start
+        sent = 0
+        started = time.time()
+
+        try:
+            if (start or end is not None) and get_path is not None:
+                # Only ask the provider for the requested range.
+                resp = self.driver.connection.request(
+                    get_path(obj.container, obj.name),
+                    headers={'Range': 'bytes={0}-{1}'.format(
+                        start, '' if end is None else end
+                    )},
+                    raw=True
+                )
+                if resp.status == 206:
+                    skip = 0
+                elif resp.status == 404:
+                    raise ObjectDoesNotExistError(
+                        value='', driver=self.driver, object_name=obj.name
+                    )
+                elif resp.status != 200:
+                    raise LibcloudError(
+                        'Unexpected status code: {0}'.format(resp.status),
+                        driver=self.driver
+                    )
+                chunks = read_in_chunks(
+                    resp.response, chunk_size=chunk_size, fill_size=True
+                )
+            else:
+                chunks = self.driver.download_object_as_stream(
+                    obj, chunk_size=chunk_size
+                )
+
+            remaining = None if end is None else end - start + 1
+            for chunk in chunks:
+                # Providers that ignore the Range header send the whole
+                # object, so the unwanted part is dropped here.
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip -= dropped
+                if remaining is not None:
+                    chunk = chunk[:remaining]
+                    remaining -= len(chunk)
+                if chunk:
+                    sent += len(chunk)
+                    yield chunk
+                if remaining == 0:
+                    break
+        except Exception:
+            stats.record(
+                'download_object', time.time() - started, sent, error=True
+            )
+            raise
+        stats.record('download_object', time.time() - started, sent)
 
     def get_url_from_filename(self, rid, filename, content_type=None):
         """
@@ -291,56 +1528,80 @@ class ResourceCloudStorage(CloudStorage):
 
         :returns: Externally accessible URL or None.
         """
+        return self.get_download_url(rid, filename, content_type)[0]
+
+    def get_download_url(self, rid, filename, content_type=None):
+        """
+        Like `get_url_from_filename`, but also return how many seconds the
+        URL can be cached for.
+
+        :returns: A (url, max_age) tuple. The URL is None if the object
+                  doesn't exist.
+        """
         # Find the key the file *should* be stored at.
         path = self.path_from_filename(rid, filename)
 
-        # If advanced azure features are enabled, generate a temporary
-        # shared access link instead of simply redirecting to the file.
-        if self.can_use_advanced_azure and self.use_secure_urls:
-            from azure.storage import blob as azure_blob
+        sign = None
+        if self.cdn_signing and (self.use_secure_urls or self._is_private()):
+            sign = self.get_signed_cdn_url
+        elif self.use_secure_urls and self.can_sign_urls:
+            sign = self.get_secure_url
 
-            blob_service = azure_blob.BlockBlobService(
-                self.driver_options['key'],
-                self.driver_options['secret']
-            )
+        if sign is not None:
+            cache_key = (rid, filename, content_type)
+            cached = secure_url_cache.get(cache_key)
+            if cached is None:
+                with stats.timed('sign_url'):
+                    url = sign(path, content_type=content_type)
+                cached = (url, time.time() + self.secure_url_lifetime)
+                secure_url_cache.set(cache_key, cached)
+            url, expires = cached
+            return url, max(0, int(expires - time.time()))
 
-            return blob_service.make_blob_url(
-                container_name=self.container_name,
-                blob_name=path,
-                sas_token=blob_service.generate_blob_shared_access_signature(
-                    container_name=self.container_name,
-                    blob_name=path,
-                    expiry=datetime.utcnow() + timedelta(hours=1),
-                    permission=azure_blob.BlobPermissions.READ
-                )
-            )
-        elif self.can_use_advanced_aws and self.use_secure_urls:
-            from boto.s3.connection import S3Connection
-            s3_connection = S3Connection(
-                self.driver_options['key'],
-                self.driver_options['secret']
-            )
+        if missing_object_cache.get(path):
+            return None, 0
 
-            generate_url_params = {"expires_in": 60 * 60,
-                                   "method": "GET",
-                                   "bucket": self.container_name,
-                                   "query_auth": True,
-                                   "key": path}
-            if content_type:
-                generate_url_params['headers'] = {"Content-Type": content_type}
+        if self.use_manifest:
+            if model.Session.query(CloudStorageObject).get(path) is None:
+                return None, 0
+            return self.get_public_url(path), self.public_url_max_age
 
-            return s3_connection.generate_url(**generate_url_params)
+        if not self.check_object_exists:
+            return self.get_public_url(path), self.public_url_max_age
 
         # Find the object for the given key.
-        obj = self.container.get_object(path)
+        try:
+            with stats.timed('get_object', expected=ObjectDoesNotExistError):
+                obj = self.container.get_object(path)
+        except ObjectDoesNotExistError:
+            obj = None
         if obj is None:
-            return
+            return None, 0
+
+        return self.get_public_url(path, obj=obj), self.public_url_max_age
+
+    def get_public_url(self, path, obj=None):
+        """
+        Build the public URL for the object at `path`.
+
+        :param path: The object's key in the container.
+        :param obj: Optionally the libcloud Object for `path`. If it isn't
+                    given the URL is built without a request to the provider.
+
+        :returns: The public URL.
+        """
+        if self.cdn_url:
+            return cdn.cdn_url(self.cdn_url, path, _setting('cdn_path_map'))
+
+        local = obj is None
+        if local:
+            obj = self.make_object(path)
 
         # Not supported by all providers!
         try:
             return self.driver.get_object_cdn_url(obj)
         except NotImplementedError:
-            if 'S3' in self.driver_name:
+            if 'S3' in self.driver_name or local:
                 return urlparse.urljoin(
                     'https://' + self.driver.connection.host,
                     '{container}/{path}'.format(
@@ -354,6 +1615,66 @@ class ResourceCloudStorage(CloudStorage):
                 return obj.extra['url']
             raise
 
+    def get_signed_cdn_url(self, path, content_type=None):
+        """
+        Sign a CDN URL for the object at `path`, valid for
+        `secure_url_lifetime` seconds, without a request to the provider.
+
+        :param path: The object's key in the container.
+        :param content_type: Unused, CDN signatures don't cover headers.
+
+        :returns: The signed URL.
+        """
+        url = self.get_public_url(path)
+        expires = time.time() + self.secure_url_lifetime
+        if self.cdn_signing == 'cloudfront':
+            return cdn.sign_cloudfront(
+                url,
+                _setting('cdn_key_pair_id'),
+                _setting('cdn_private_key'),
+                expires
+            )
+        return cdn.sign_hmac(
+            url,
+            _setting('cdn_signing_key'),
+            expires,
+            token_name=_setting('cdn_token_name')
+        )
+
+    def get_secure_url(self, path, content_type=None):
+        """
+        Sign a temporary URL for the object at `path`, valid for
+        `secure_url_lifetime` seconds. The signature is computed locally,
+        without a request to the provider.
+
+        :param path: The object's key in the container.
+        :param content_type: Optionally a Content-Type header.
+
+        :returns: The signed URL or None if the driver doesn't support it.
+        """
+        if self.driver_name == 'AZURE_BLOBS':
+            # A temporary shared access link instead of simply redirecting
+            # to the file.
+            return signing.sign_azure_blob(
+                self.driver_options['key'],
+                self.driver_options['secret'],
+                self.container_name,
+                path,
+                self.secure_url_lifetime
+            )
+        elif 'S3' in self.driver_name:
+            return signing.presign_s3(
+                self.driver.connection.host,
+                self.container_name,
+                path,
+                self.driver_options['key'],
+                self.driver_options['secret'],
+                self.region,
+                self.secure_url_lifetime,
+                content_type=content_type,
+                token=self.driver_options.get('token')
+            )
+
     @property
     def package(self):
         return model.Package.get(self.resource['package_id'])
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+
+from ckanext.cloudstorage.cache import TTLCache
+
+
+def test_get_set():
+    cache = TTLCache(10, 60)
+    assert cache.get('a') is None
+    assert cache.get('a', 'default') == 'default'
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.stats() == {
+        'size': 1, 'maxsize': 10, 'hits': 1, 'misses': 2
+    }
+
+
+def test_evicts_least_recently_used():
+    cache = TTLCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_expires():
+    cache = TTLCache(10, 60)
+    cache.set('a', 1, ttl=-1)
+    cache.set('b', 2)
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+    assert cache.stats()['size'] == 1
+
+
+def test_expires_after_ttl():
+    cache = TTLCache(10, 60)
+    real_time = time.time
+    now = real_time()
+    try:
+        time.time = lambda: now
+        cache.set('a', 1)
+        time.time = lambda: now + 59
+        assert cache.get('a') == 1
+        time.time = lambda: now + 60
+        assert cache.get('a') is None
+    finally:
+        time.time = real_time
+
+
+def test_disabled():
+    cache = TTLCache(0, 60)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_pop_clear():
+    cache = TTLCache(10, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'default') == 'default'
+    cache.get('b')
+    cache.clear()
+    assert cache.get('b') is None
+    assert cache.stats() == {
+        'size': 0, 'maxsize': 10, 'hits': 0, 'misses': 1
+    }
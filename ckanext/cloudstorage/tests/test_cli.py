@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import tempfile
+
+from libcloud.storage.base import Object
+import ckan.model as model
+
+from ckanext.cloudstorage import cli, storage
+from ckanext.cloudstorage.model import CloudStorageObject, create_tables
+
+MiB = 1024 * 1024
+
+
+def _configure(**options):
+    config = {
+        'ckanext.cloudstorage.driver': 'S3',
+        'ckanext.cloudstorage.driver_options': repr({
+            'key': 'key',
+            'secret': 'secret'
+        }),
+        'ckanext.cloudstorage.container_name': 'container',
+    }
+    config.update(
+        ('ckanext.cloudstorage.' + key, str(value))
+        for key, value in options.items()
+    )
+    storage.configure(config)
+
+
+def _write_file(data):
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as fout:
+        fout.write(data)
+    return path
+
+
+def _multipart_etag(data, part_size):
+    digests = [
+        hashlib.md5(data[i:i + part_size]).digest()
+        for i in range(0, len(data), part_size)
+    ]
+    return '{0}-{1}'.format(
+        hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def test_is_unchanged_configured_part_size():
+    _configure(multipart_part_size=16 * MiB)
+    data = os.urandom(1024) * (33 * 1024 + 7)
+    etag = _multipart_etag(data, 16 * MiB)
+    path = _write_file(data)
+    try:
+        assert cli._is_unchanged(path, len(data), etag)
+        assert not cli._is_unchanged(path, len(data), _multipart_etag(
+            data[:-1] + b'x', 16 * MiB))
+    finally:
+        os.remove(path)
+
+
+def test_file_md5():
+    data = os.urandom(3 * MiB + 11)
+    path = _write_file(data)
+    try:
+        assert cli._file_md5(path) == hashlib.md5(data).hexdigest()
+        # Part sizes that aren't multiples of the read buffer.
+        for part_size in (MiB + 3, 3 * MiB + 11, 5 * MiB):
+            assert cli._file_md5(path, part_size) == _multipart_etag(
+                data, part_size)
+    finally:
+        os.remove(path)
+
+
+def test_file_md5_exact_parts():
+    data = os.urandom(2 * MiB)
+    path = _write_file(data)
+    try:
+        assert cli._file_md5(path, MiB) == _multipart_etag(data, MiB)
+        assert cli._file_md5(path, MiB).endswith('-2')
+    finally:
+        os.remove(path)
+
+
+def test_file_md5_empty():
+    path = _write_file(b'')
+    try:
+        assert cli._file_md5(path) == hashlib.md5(b'').hexdigest()
+        # An empty multipart upload still has one part.
+        assert cli._file_md5(path, MiB) == '{0}-1'.format(
+            hashlib.md5(hashlib.md5(b'').digest()).hexdigest())
+    finally:
+        os.remove(path)
+
+
+def test_is_unchanged():
+    _configure()
+    data = os.urandom(1024)
+    path = _write_file(data)
+    try:
+        etag = hashlib.md5(data).hexdigest()
+        assert cli._is_unchanged(path, len(data), etag)
+        assert not cli._is_unchanged(path, len(data) + 1, etag)
+        assert not cli._is_unchanged(
+            path, len(data), hashlib.md5(b'x').hexdigest())
+    finally:
+        os.remove(path)
+
+
+def test_is_unchanged_libcloud_part_size():
+    _configure()
+    data = os.urandom(1024) * (11 * 1024)
+    path = _write_file(data)
+    try:
+        assert cli._is_unchanged(path, len(data), _multipart_etag(
+            data, cli.LIBCLOUD_PART_SIZE))
+    finally:
+        os.remove(path)
+
+
+def _listed(key, etag):
+    return Object(key, 3, etag, {'content_type': 'text/csv'}, {}, None, None)
+
+
+def test_reconcile_batch_quoted_etag():
+    create_tables()
+    keys = [u'resources/rid/same.csv', u'resources/rid/changed.csv']
+    CloudStorageObject.forget(keys)
+    for key in keys:
+        CloudStorageObject.record(
+            key, u'rid', size=3, etag='"abc"', content_encoding=u'gzip',
+            content_hash=u'hash', commit=False)
+    model.Session.commit()
+    # Entries recorded by older versions kept the quotes.
+    model.Session.query(CloudStorageObject).filter(
+        CloudStorageObject.key.in_(keys)
+    ).update({'etag': u'"abc"'}, synchronize_session=False)
+    model.Session.commit()
+
+    cli._reconcile_batch(
+        [_listed(keys[0], 'abc'), _listed(keys[1], 'def')], set())
+
+    same = model.Session.query(CloudStorageObject).get(keys[0])
+    assert same.etag == u'abc'
+    assert same.content_encoding == u'gzip'
+    assert same.content_hash == u'hash'
+    changed = model.Session.query(CloudStorageObject).get(keys[1])
+    assert changed.etag == u'def'
+    assert changed.content_encoding is None
+    assert changed.content_hash is None
+    CloudStorageObject.forget(keys)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from ckanext.cloudstorage.controller import _parse_range
+
+
+def test_parse_range():
+    assert _parse_range('bytes=0-99', 1000) == (0, 99)
+    assert _parse_range('bytes=100-', 1000) == (100, 999)
+    assert _parse_range('bytes=900-2000', 1000) == (900, 999)
+    assert _parse_range(' bytes = 0 - 0 ', 1000) == (0, 0)
+
+
+def test_parse_range_str_size():
+    assert _parse_range('bytes=0-99', '1000') == (0, 99)
+    assert _parse_range('bytes=-100', '1000') == (900, 999)
+    assert _parse_range('bytes=1000-', '1000') is False
+
+
+def test_parse_range_suffix():
+    assert _parse_range('bytes=-100', 1000) == (900, 999)
+    assert _parse_range('bytes=-2000', 1000) == (0, 999)
+    assert _parse_range('bytes=-0', 1000) is False
+
+
+def test_parse_range_unsatisfiable():
+    assert _parse_range('bytes=1000-', 1000) is False
+    assert _parse_range('bytes=1000-1001', 1000) is False
+
+
+def test_parse_range_ignored():
+    assert _parse_range('bytes=0-99', None) is None
+    assert _parse_range('bytes=-', 1000) is None
+    assert _parse_range('bytes=100-0', 1000) is None
+    assert _parse_range('bytes=0-1,5-9', 1000) is None
+    assert _parse_range('items=0-9', 1000) is None
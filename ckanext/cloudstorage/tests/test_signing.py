@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from ckanext.cloudstorage import signing
+
+# 2023-11-14T22:13:20Z
+NOW = 1700000000
+
+S3_ARGS = dict(
+    host='s3.eu-west-1.amazonaws.com',
+    bucket='mybucket',
+    path=u'resources/ab c/dé.csv',
+    access_key='AKIDEXAMPLE',
+    secret='wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+    region='eu-west-1',
+    expires_in=3600,
+    now=NOW
+)
+S3_URL = (
+    'https://s3.eu-west-1.amazonaws.com/mybucket/resources/ab%20c/'
+    'd%C3%A9.csv?X-Amz-Algorithm=AWS4-HMAC-SHA256'
+    '&X-Amz-Credential=AKIDEXAMPLE%2F20231114%2Feu-west-1%2Fs3%2F'
+    'aws4_request&X-Amz-Date=20231114T221320Z&X-Amz-Expires=3600'
+)
+
+
+def test_presign_s3():
+    assert signing.presign_s3(**S3_ARGS) == (
+        S3_URL +
+        '&X-Amz-SignedHeaders=host&X-Amz-Signature='
+        '358a361626617549ea1449194fa6fe001baaa8a93d231da90fd79f8bd0fc0be2'
+    )
+
+
+def test_presign_s3_content_type():
+    assert signing.presign_s3(content_type='text/csv', **S3_ARGS) == (
+        S3_URL +
+        '&X-Amz-SignedHeaders=content-type%3Bhost&X-Amz-Signature='
+        '42b07136752f3e3430736ea42a3ab40373b15d04bf18670a60acc9bdd9b5c3b0'
+    )
+
+
+def test_presign_s3_token():
+    assert signing.presign_s3(token='SESSIONTOKEN', **S3_ARGS) == (
+        S3_URL +
+        '&X-Amz-Security-Token=SESSIONTOKEN&X-Amz-SignedHeaders=host'
+        '&X-Amz-Signature='
+        '1d7fff771cdc6880cf8d183277e699fa748c5ba7a89c010f1b60267897b946fb'
+    )
+
+
+def test_presign_s3_multipart_part():
+    url = signing.presign_s3(
+        token='SESSIONTOKEN',
+        method='PUT',
+        params={'partNumber': 7, 'uploadId': u'VXBsb2FkIElE.x-y_z'},
+        **S3_ARGS
+    )
+    assert url == (
+        S3_URL +
+        '&X-Amz-Security-Token=SESSIONTOKEN&X-Amz-SignedHeaders=host'
+        '&partNumber=7&uploadId=VXBsb2FkIElE.x-y_z&X-Amz-Signature='
+        '06c10b530c26ac9396882186426481385ec90a23ad8ee568660730f5dfc1e5ac'
+    )
+
+
+def test_presign_s3_expires_capped():
+    url = signing.presign_s3(**dict(S3_ARGS, expires_in=30 * 24 * 60 * 60))
+    assert '&X-Amz-Expires=604800&' in url
+
+
+def test_sign_azure_blob():
+    url = signing.sign_azure_blob(
+        'acct',
+        'ZmFrZWtleWZha2VrZXlmYWtla2V5',
+        'cont',
+        u'resources/ab c/dé.csv',
+        3600,
+        now=NOW
+    )
+    assert url == (
+        'https://acct.blob.core.windows.net/cont/resources/ab%20c/'
+        'd%C3%A9.csv?sv=2018-11-09&se=2023-11-14T23%3A13%3A20Z&sr=b&sp=r'
+        '&sig=cKCXJc0Sjrej7W%2F1a1GnURc8Eslmx4sUqQOsTlHs8ZY%3D'
+    )